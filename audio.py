@@ -1,5 +1,17 @@
+import os
+import gzip
+import json
+import math
+import struct
+import hashlib
+import tempfile
 import subprocess
+import collections
+import functools
+import threading
+import multiprocessing.pool
 import torch
+import torch.nn.functional as F
 import numpy as np
 import librosa
 import soundfile
@@ -7,9 +19,183 @@ import scipy.io.wavfile
 import models
 
 smax = torch.iinfo(torch.int16).max
-f2s_numpy = lambda signal, max = np.float32(smax): np.multiply(signal, max, dtype = 'int16')
+# clipped: resampled and augmented signals overshoot [-1, 1] and would wrap around to the opposite sign
+f2s_numpy = lambda signal, max = np.float32(smax): np.clip(np.multiply(signal, max), -smax - 1, smax).astype('int16')
 s2f_numpy = lambda signal, max = np.float32(smax): np.divide(signal, max, dtype = 'float32')
 
+
+class DecoderPool:
+	# keeps libsndfile decoders open across calls, so a DataLoader worker does not fork+exec ffmpeg/sox per file.
+	# seek + read on a decoder is not atomic, so every decoder has its own lock and reads from concurrent threads on one file are serialized
+	def __init__(self, max_open = 16):
+		self.max_open = max_open
+		self.decoders = collections.OrderedDict()
+		self.pid = os.getpid()
+		self.lock = threading.Lock()
+		# reads served by the ffmpeg fallback of read_audio(backend = 'pool'), benchmarks must not mistake those for pool reads
+		self.num_fallbacks = 0
+
+	def open(self, audio_path):
+		evicted = []
+		with self.lock:
+			if self.pid != os.getpid():
+				# decoders inherited over fork share file offsets with the parent process
+				self.decoders, self.pid = collections.OrderedDict(), os.getpid()
+
+			entry = self.decoders.pop(audio_path, None) or (soundfile.SoundFile(audio_path), threading.Lock())
+			self.decoders[audio_path] = entry
+			while len(self.decoders) > self.max_open:
+				evicted.append(self.decoders.popitem(last = False)[1])
+		for decoder, lock in evicted:
+			with lock:
+				decoder.close()
+		return entry
+
+	def discard(self, audio_path, decoder):
+		# a decoder that raised may be left in a bad state (e.g. a failed seek), so it is not reused
+		with self.lock:
+			if audio_path in self.decoders and self.decoders[audio_path][0] is decoder:
+				del self.decoders[audio_path]
+		decoder.close()
+
+	def read(self, audio_path, offset = 0, duration = None, raw_dtype = 'int16', frame_offset = None, num_frames = None):
+		# offsets past the end give an empty signal, like read_wav_mmap
+		decoder, lock = self.open(audio_path)
+		try:
+			with lock:
+				if decoder.closed:
+					# evicted by another thread in between
+					with soundfile.SoundFile(audio_path) as decoder_:
+						return self.read_frames(decoder_, offset, duration, raw_dtype, frame_offset, num_frames)
+				return self.read_frames(decoder, offset, duration, raw_dtype, frame_offset, num_frames)
+		except Exception:
+			self.discard(audio_path, decoder)
+			raise
+
+	@staticmethod
+	def read_frames(decoder, offset, duration, raw_dtype, frame_offset, num_frames):
+		begin = min(frame_offset if frame_offset is not None else int(offset * decoder.samplerate), decoder.frames)
+		num_frames = num_frames if num_frames is not None else int(duration * decoder.samplerate) if duration is not None else -1
+		decoder.seek(begin)
+		return decoder.samplerate, decoder.read(num_frames, dtype = raw_dtype, always_2d = True)
+
+	def close(self):
+		with self.lock:
+			while self.decoders:
+				self.decoders.popitem()[1][0].close()
+
+
+decoder_pool = DecoderPool()
+
+
+class DecodedAudioCache:
+	# decoded and resampled audio stored as int16 wav named by content key, read back through read_wav_mmap;
+	# writes are atomic renames and eviction tolerates concurrent readers, so DataLoader workers can share one cache_dir
+	def __init__(self, cache_dir, max_size = None, evict_every = 256):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		self.evict_every = evict_every
+		self.num_writes = 0
+
+	def path(self, audio_path, sample_rate, mono):
+		stat = os.stat(audio_path)
+		key = repr((os.path.abspath(audio_path), stat.st_mtime_ns, stat.st_size, sample_rate, bool(mono)))
+		digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+		return os.path.join(self.cache_dir, digest[:2], digest + '.wav')
+
+	def read_audio(self, audio_path, sample_rate, offset = 0, duration = None, mono = True, dtype = 'float32', **kwargs):
+		cache_path = self.path(audio_path, sample_rate, mono)
+		try:
+			os.utime(cache_path)
+		except FileNotFoundError:
+			signal, sample_rate_ = read_audio(audio_path, sample_rate, mono = mono, dtype = 'float32', **kwargs)
+			self.write(cache_path, signal, sample_rate_)
+
+		try:
+			return read_audio(cache_path, sample_rate, offset = offset, duration = duration, mono = mono, dtype = dtype, backend = 'mmap')
+		except FileNotFoundError:
+			# evicted by another worker in between
+			return read_audio(audio_path, sample_rate, offset = offset, duration = duration, mono = mono, dtype = dtype, **kwargs)
+
+	def write(self, cache_path, signal, sample_rate):
+		os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+		fd, tmp_path = tempfile.mkstemp(suffix = '.tmp', dir = os.path.dirname(cache_path))
+		os.close(fd)
+		write_audio(tmp_path, signal, sample_rate)
+		os.replace(tmp_path, cache_path)
+
+		self.num_writes += 1
+		if self.max_size is not None and self.num_writes % self.evict_every == 0:
+			self.evict()
+
+	def evict(self):
+		entries = []
+		for subdir in os.scandir(self.cache_dir):
+			for entry in os.scandir(subdir.path) if subdir.is_dir() else []:
+				try:
+					if entry.name.endswith('.wav'):
+						stat = entry.stat()
+						entries.append((stat.st_mtime, stat.st_size, entry.path))
+				except FileNotFoundError:
+					pass
+
+		size = sum(size for mtime, size, path in entries)
+		for mtime, size_, path in sorted(entries):
+			if size <= self.max_size:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			size -= size_
+
+
+def read_wav_header(audio_path):
+	# walks RIFF chunks up to the data chunk, only int16 and float32 PCM can be memory-mapped as is
+	with open(audio_path, 'rb') as f:
+		riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+		assert riff in [b'RIFF', b'RF64'] and wave == b'WAVE', f'Not a WAV file [{audio_path}]'
+		fmt = None
+		while True:
+			chunk_header = f.read(8)
+			if len(chunk_header) < 8:
+				raise ValueError(f'No data chunk in [{audio_path}]')
+			chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+			if chunk_id == b'fmt ':
+				chunk = f.read(chunk_size + chunk_size % 2)
+				format_tag, num_channels, sample_rate, _, block_align, bits_per_sample = struct.unpack('<HHIIHH', chunk[:16])
+				if format_tag == 0xFFFE and len(chunk) >= 26:
+					format_tag = struct.unpack('<H', chunk[24:26])[0]
+				fmt = dict(format_tag = format_tag, num_channels = num_channels, sample_rate = sample_rate, block_align = block_align, bits_per_sample = bits_per_sample)
+			elif chunk_id == b'data':
+				assert fmt is not None, f'No fmt chunk before data chunk in [{audio_path}]'
+				data_offset = f.tell()
+				break
+			else:
+				f.seek(chunk_size + chunk_size % 2, 1)
+
+	dtype = {(1, 16): 'int16', (3, 32): 'float32'}.get((fmt['format_tag'], fmt['bits_per_sample']))
+	file_size = os.path.getsize(audio_path)
+	data_size = min(chunk_size, file_size - data_offset) if chunk_size != 0xFFFFFFFF else file_size - data_offset
+	return dict(fmt, dtype = dtype, data_offset = data_offset, num_frames = data_size // fmt['block_align'])
+
+
+def read_wav_mmap(audio_path, offset = 0, duration = None, header = None):
+	header = header or read_wav_header(audio_path)
+	begin = min(int(offset * header['sample_rate']), header['num_frames']) if offset else 0
+	end = min(begin + int(duration * header['sample_rate']), header['num_frames']) if duration is not None else header['num_frames']
+	if end <= begin:
+		return header['sample_rate'], np.zeros((0, header['num_channels']), dtype = header['dtype'])
+	# copy-on-write mapping: only the touched pages are read, and the result is writeable so torch can share it
+	return header['sample_rate'], np.memmap(
+		audio_path,
+		dtype = header['dtype'],
+		mode = 'c',
+		offset = header['data_offset'] + begin * header['block_align'],
+		shape = (end - begin, header['num_channels'])
+	)
+
+
 def read_audio(
 	audio_path,
 	sample_rate,
@@ -23,83 +209,88 @@ def read_audio(
 	raw_bytes = None,
 	raw_sample_rate = None,
 	raw_num_channels = None,
+	cache = None
 ):
 	assert dtype in ['int16', 'float32']
+	sliced = False
+
+	if cache is not None and audio_path is not None:
+		return cache.read_audio(audio_path, sample_rate, offset = offset, duration = duration, mono = mono, dtype = dtype, raw_dtype = raw_dtype, backend = backend)
 
 	try:
+		header = read_wav_header(audio_path) if backend in ['mmap', None] and audio_path is not None and audio_path.endswith('.wav') else None
+
 		if audio_path is None or audio_path.endswith('.raw'):
 			if audio_path is not None:
 				with open(audio_path, 'rb') as f:
 					raw_bytes = f.read()
 			sample_rate_, signal = raw_sample_rate, np.frombuffer(raw_bytes, dtype = raw_dtype).reshape(-1, raw_num_channels)
 
-		elif backend in ['scipy', None] and audio_path.endswith('.wav'):
+		elif (header is not None and header['dtype'] is None) or (backend == 'mmap' and header is None):
+			# non-wav files and wav that can not be memory-mapped as is (e.g. 24-bit pcm) go through the pool path with its ffmpeg fallback
+			return read_audio(
+				audio_path,
+				sample_rate,
+				offset = offset,
+				duration = duration,
+				mono = mono,
+				raw_dtype = raw_dtype,
+				dtype = dtype,
+				byte_order = byte_order,
+				backend = 'pool'
+			)
+
+		elif header is not None:
+			sample_rate_, signal = read_wav_mmap(audio_path, offset = offset, duration = duration, header = header)
+			sliced = True
+
+		elif backend == 'scipy' and audio_path.endswith('.wav'):
 			sample_rate_, signal = scipy.io.wavfile.read(audio_path)
 			signal = signal[:, None] if len(signal.shape) == 1 else signal
 
 		elif backend == 'soundfile':
-			signal, sample_rate_ = soundfile.read(audio_path, dtype = raw_dtype)
-			signal = signal[:, None] if len(signal.shape) == 1 else signal
+			with soundfile.SoundFile(audio_path) as f:
+				# clamped like DecoderPool.read_frames, offsets past the end give an empty signal
+				f.seek(min(int(offset * f.samplerate), f.frames)) if offset else None
+				sample_rate_, signal = f.samplerate, f.read(int(duration * f.samplerate) if duration is not None else -1, dtype = raw_dtype, always_2d = True)
+			sliced = True
+
+		elif backend == 'pool':
+			try:
+				sample_rate_, signal = decoder_pool.read(audio_path, offset = offset, duration = duration, raw_dtype = raw_dtype)
+				sliced = True
+			except RuntimeError:
+				# format not supported by libsndfile (e.g. m4a, gsm), fall back to a one-off ffmpeg process
+				with decoder_pool.lock:
+					decoder_pool.num_fallbacks += 1
+				return read_audio(
+					audio_path,
+					sample_rate,
+					offset = offset,
+					duration = duration,
+					mono = mono,
+					raw_dtype = raw_dtype,
+					dtype = dtype,
+					byte_order = byte_order,
+					backend = 'ffmpeg'
+				)
 
 		elif backend == 'sox':
-			num_channels = int(subprocess.check_output(['soxi', '-V0', '-c', audio_path])) if not mono else 1
-			params_fmt = ['-b', '16', '-e', 'signed'] if raw_dtype == 'int16' else ['-b', '32', '-e', 'float']
-			params = [
-				'sox',
-				'-V0',
-				audio_path
-				] + params_fmt +[
-				'--endian',
-				byte_order,
-				'-r',
-				str(sample_rate),
-				'-c',
-				str(num_channels),
-				'-t',
-				'raw',
-				'-'
-			]
-			sample_rate_, signal = sample_rate, np.frombuffer(subprocess.check_output(params), dtype = raw_dtype).reshape(-1, num_channels)
+			num_channels = probe_num_channels(audio_path, backend) if not mono else 1
+			sample_rate_, signal = sample_rate, np.frombuffer(subprocess.check_output(decoder_params(audio_path, sample_rate, num_channels, raw_dtype, byte_order, backend, offset = offset, duration = duration)), dtype = raw_dtype).reshape(-1, num_channels)
+			sliced = True
+
 		elif backend in ['ffmpeg', None]:
-			num_channels = int(
-				subprocess.check_output([
-					'ffprobe',
-					'-i',
-					audio_path,
-					'-show_entries',
-					'stream=channels',
-					'-select_streams',
-					'a:0',
-					'-of',
-					'compact=p=0:nk=1',
-					'-v',
-					'0'
-				])
-			) if not mono else 1
-			params_fmt = ['-f', 's16le'] if raw_dtype == 'int16' else ['-f', 'f32le']
-			params = [
-				'ffmpeg',
-				'-i',
-				audio_path,
-				'-nostdin',
-				'-hide_banner',
-				'-nostats',
-				'-loglevel',
-				'quiet'] + params_fmt + [
-				'-ar',
-				str(sample_rate),
-				'-ac',
-				str(num_channels),
-				'-'
-			]
-			sample_rate_, signal = sample_rate, np.frombuffer(subprocess.check_output(params), dtype = raw_dtype).reshape(-1, num_channels)
+			num_channels = probe_num_channels(audio_path, backend) if not mono else 1
+			sample_rate_, signal = sample_rate, np.frombuffer(subprocess.check_output(decoder_params(audio_path, sample_rate, num_channels, raw_dtype, byte_order, backend, offset = offset, duration = duration)), dtype = raw_dtype).reshape(-1, num_channels)
+			sliced = True
 
 	except:
 		raise
 		print(f'Error when reading [{audio_path}]')
 		sample_rate_, signal = sample_rate, np.array([[]], dtype = dtype)
 
-	if offset or duration is not None:
+	if (offset or duration is not None) and not sliced:
 		signal = signal[
 						slice(
 							int(offset * sample_rate_) if offset else None,
@@ -109,18 +300,186 @@ def read_audio(
 	assert signal.dtype in [np.int16, np.float32]
 	signal = signal.T
 	
-	if signal.dtype is np.int16 and dtype == 'float32':
+	if signal.dtype == np.int16 and dtype == 'float32':
 		signal = s2f_numpy(signal)
 	
 	if mono and len(signal) > 1:
-		assert signal.dtype is np.float32
+		assert signal.dtype == np.float32
 		signal = signal.mean(0, keepdims = True)
 
 	if sample_rate_ != sample_rate:
-		assert signal.dtype is np.float32
+		assert signal.dtype == np.float32
 		signal, sample_rate_ = resample(signal, sample_rate_, sample_rate)
+		signal = signal.numpy()
+
+	return torch.as_tensor(signal if signal.flags.writeable else signal.copy()), sample_rate_
+
+
+def read_audio_chunks(
+	audio_path,
+	sample_rate,
+	chunk_duration,
+	overlap_duration = 0,
+	mono = True,
+	raw_dtype = 'int16',
+	dtype = 'float32',
+	byte_order = 'little',
+	backend = None,
+	raw_sample_rate = None,
+	raw_num_channels = None,
+	block_duration = 1.0
+):
+	# yields [num_channels x chunk] tensors (last one may be shorter), chunks start every chunk_duration - overlap_duration seconds
+	assert dtype in ['int16', 'float32'] and 0 <= overlap_duration < chunk_duration
+	chunk, hop = int(chunk_duration * sample_rate), int((chunk_duration - overlap_duration) * sample_rate)
+
+	sample_rate_, blocks = read_audio_blocks(audio_path, sample_rate, mono = mono, raw_dtype = raw_dtype, byte_order = byte_order, backend = backend, raw_sample_rate = raw_sample_rate, raw_num_channels = raw_num_channels, block_duration = block_duration)
+	blocks = (block.T for block in blocks)
+	# int16 blocks stay native unless float output, downmixing or resampling needs them as float
+	to_float = lambda block: block.dtype == np.int16 and (dtype == 'float32' or (mono and len(block) > 1) or sample_rate_ != sample_rate)
+	blocks = (s2f_numpy(block) if to_float(block) else block for block in blocks)
+	if mono:
+		blocks = (block.mean(0, keepdims = True) if len(block) > 1 else block for block in blocks)
+	if sample_rate_ != sample_rate:
+		blocks = resample_blocks(blocks, sample_rate_, sample_rate)
+	if dtype == 'int16':
+		blocks = (f2s_numpy(block) if block.dtype == np.float32 else block for block in blocks)
+
+	buffer, num_chunks = None, 0
+	for block in blocks:
+		buffer = np.concatenate([buffer, block], axis = -1) if buffer is not None else block
+		while buffer.shape[-1] >= chunk:
+			yield torch.as_tensor(buffer[:, :chunk].copy())
+			buffer, num_chunks = buffer[:, hop:], num_chunks + 1
+
+	if buffer is not None and buffer.shape[-1] > (chunk - hop if num_chunks > 0 else 0):
+		yield torch.as_tensor(buffer.copy())
+
+
+def read_audio_blocks(
+	audio_path,
+	sample_rate,
+	mono = True,
+	raw_dtype = 'int16',
+	byte_order = 'little',
+	backend = None,
+	raw_sample_rate = None,
+	raw_num_channels = None,
+	block_duration = 1.0
+):
+	# returns decoder sample rate and a generator of [frames x num_channels] numpy blocks, decoded incrementally
+	if audio_path.endswith('.raw'):
+		block_frames = int(block_duration * raw_sample_rate)
+
+		def blocks():
+			with open(audio_path, 'rb') as f:
+				for block in iter(lambda: f.read(block_frames * raw_num_channels * np.dtype(raw_dtype).itemsize), b''):
+					yield np.frombuffer(block, dtype = raw_dtype).reshape(-1, raw_num_channels)
+
+		return raw_sample_rate, blocks()
+
+	elif backend in ['mmap', 'pool', 'soundfile', 'scipy'] or (backend is None and audio_path.endswith('.wav')):
+		header = read_wav_header(audio_path) if audio_path.endswith('.wav') else dict(dtype = None)
+		if header['dtype'] is not None:
+			_, signal = read_wav_mmap(audio_path, header = header)
+			block_frames = int(block_duration * header['sample_rate'])
+			return header['sample_rate'], (signal[k:k + block_frames] for k in range(0, len(signal), block_frames))
+
+		sample_rate_ = soundfile.info(audio_path).samplerate
+		return sample_rate_, soundfile.blocks(audio_path, blocksize = int(block_duration * sample_rate_), dtype = raw_dtype, always_2d = True)
+
+	else:
+		num_channels = probe_num_channels(audio_path, backend) if not mono else 1
+		block_bytes = int(block_duration * sample_rate) * num_channels * np.dtype(raw_dtype).itemsize
+
+		def blocks():
+			proc = subprocess.Popen(decoder_params(audio_path, sample_rate, num_channels, raw_dtype, byte_order, backend), stdout = subprocess.PIPE)
+			try:
+				for block in iter(lambda: proc.stdout.read(block_bytes), b''):
+					yield np.frombuffer(block[:len(block) - len(block) % (num_channels * np.dtype(raw_dtype).itemsize)], dtype = raw_dtype).reshape(-1, num_channels)
+				assert proc.wait() == 0, f'Decoder failed on [{audio_path}]'
+			finally:
+				proc.kill()
+				proc.stdout.close()
+
+		return sample_rate, blocks()
+
 
-	return torch.as_tensor(signal.copy()), sample_rate_
+def resample_blocks(blocks, sample_rate_, sample_rate, context_duration = 0.02):
+	# resamples consecutive blocks with a few milliseconds of neighbouring context on both sides, so block edges match the offline result
+	period = sample_rate_ // math.gcd(sample_rate_, sample_rate)
+	context = period * int(math.ceil(context_duration * sample_rate_ / period))
+	to_output_frames = lambda frames: frames * sample_rate // sample_rate_
+
+	buffer, begin = None, 0
+	for block in blocks:
+		buffer = np.concatenate([buffer, block], axis = -1) if buffer is not None else block
+		end = period * ((buffer.shape[-1] - context) // period)
+		if end - begin >= period:
+			resampled = np.asarray(resample(buffer[:, :end + context], sample_rate_, sample_rate)[0])
+			yield resampled[:, to_output_frames(begin):to_output_frames(end)]
+			buffer, begin = buffer[:, max(end - context, 0):], min(end, context)
+
+	if buffer is not None and buffer.shape[-1] > begin:
+		yield np.asarray(resample(buffer, sample_rate_, sample_rate)[0])[:, to_output_frames(begin):]
+
+
+def probe_num_channels(audio_path, backend = 'ffmpeg'):
+	return int(
+		subprocess.check_output(['soxi', '-V0', '-c', audio_path]) if backend == 'sox' else subprocess.check_output([
+			'ffprobe',
+			'-i',
+			audio_path,
+			'-show_entries',
+			'stream=channels',
+			'-select_streams',
+			'a:0',
+			'-of',
+			'compact=p=0:nk=1',
+			'-v',
+			'0'
+		])
+	)
+
+
+def decoder_params(audio_path, sample_rate, num_channels, raw_dtype = 'int16', byte_order = 'little', backend = 'ffmpeg', offset = 0, duration = None):
+	# offset and duration make the decoder seek instead of decoding the whole file
+	if backend == 'sox':
+		params_fmt = ['-b', '16', '-e', 'signed'] if raw_dtype == 'int16' else ['-b', '32', '-e', 'float']
+		params_trim = (['trim', str(offset)] + ([str(duration)] if duration is not None else [])) if offset or duration is not None else []
+		return [
+			'sox',
+			'-V0',
+			audio_path
+			] + params_fmt +[
+			'--endian',
+			byte_order,
+			'-r',
+			str(sample_rate),
+			'-c',
+			str(num_channels),
+			'-t',
+			'raw',
+			'-'
+		] + params_trim
+	else:
+		params_fmt = ['-f', 's16le'] if raw_dtype == 'int16' else ['-f', 'f32le']
+		params_seek = (['-ss', str(offset)] if offset else []) + (['-t', str(duration)] if duration is not None else [])
+		return [
+			'ffmpeg'] + params_seek + [
+			'-i',
+			audio_path,
+			'-nostdin',
+			'-hide_banner',
+			'-nostats',
+			'-loglevel',
+			'quiet'] + params_fmt + [
+			'-ar',
+			str(sample_rate),
+			'-ac',
+			str(num_channels),
+			'-'
+		]
 
 
 def write_audio(audio_path, signal, sample_rate, mono = False):
@@ -130,49 +489,367 @@ def write_audio(audio_path, signal, sample_rate, mono = False):
 	return audio_path
 
 
-def resample(signal, sample_rate_, sample_rate):
-	return torch.as_tensor(librosa.resample(numpy.asarray(signal), sample_rate_, sample_rate)), sample_rate
+def resample(signal, sample_rate_, sample_rate, lowpass_filter_width = 64, rolloff = 0.945, beta = 14.769656459379492):
+	# polyphase windowed sinc resampling of [... x T] numpy arrays or tensors (any leading batch/channel dims, any device)
+	signal = torch.as_tensor(signal)
+	if sample_rate_ == sample_rate:
+		return signal, sample_rate
+	kernel, width, stride, num_phases = resample_kernel(sample_rate_, sample_rate, signal.device, signal.dtype, lowpass_filter_width, rolloff, beta)
+	shape, num_frames = signal.shape[:-1], signal.shape[-1]
+	if num_frames == 0:
+		# e.g. reads at or past the end of the file, conv1d cannot pad an empty signal
+		return signal[..., :0], sample_rate
+	padded = F.pad(signal.reshape(-1, 1, num_frames), (width, width + stride))
+	resampled = F.conv1d(padded, kernel, stride = stride).transpose(1, 2).reshape(padded.shape[0], -1)
+	return resampled[:, :int(math.ceil(num_frames * sample_rate / sample_rate_))].reshape(shape + (-1, )), sample_rate
+
 
+# bounded: augmentations (transforms.resample_by_rate) request many random rate fractions over a long run
+@functools.lru_cache(maxsize = 256)
+def resample_kernel(sample_rate_, sample_rate, device, dtype, lowpass_filter_width, rolloff, beta, min_num_phases = 32):
+	gcd = math.gcd(sample_rate_, sample_rate)
+	orig, new = sample_rate_ // gcd, sample_rate // gcd
+	base_freq = min(orig, new) * rolloff
+	width = int(math.ceil(lowpass_filter_width * orig / base_freq))
+	t = (torch.arange(0, -new, -1, dtype = torch.float64)[:, None] / new +
+			torch.arange(-width, width + orig, dtype = torch.float64)[None, :] / orig) * base_freq
+	t = t.clamp(-lowpass_filter_width, lowpass_filter_width)
+	window = torch.i0(beta * (1 - (t / lowpass_filter_width)**2).sqrt()) / torch.i0(torch.tensor(beta, dtype = torch.float64))
+	t = t * math.pi
+	kernel = torch.where(t == 0, torch.ones_like(t), t.sin() / t) * window * base_freq / orig
 
-def compute_duration(audio_path, backend = 'ffmpeg'):
+	# for small ratios (e.g. 16k -> 8k has a single phase) stack shifted copies of the phases, so conv1d gets enough output channels to be efficient
+	repeat = int(math.ceil(min_num_phases / new))
+	kernel = torch.stack([F.pad(kernel, (k * orig, (repeat - 1 - k) * orig)) for k in range(repeat)]).reshape(repeat * new, 1, -1)
+	return kernel.to(device = device, dtype = dtype), width, repeat * orig, repeat * new
+
+
+def compute_duration(audio_path, backend = None):
+	# backend = None parses the container header in-process and only spawns ffprobe if the header is not understood
+	info = probe_header(audio_path) if backend in ['header', None] else None
+	if info is not None or backend == 'header':
+		return info['duration'] if info is not None else None
 	cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1'
-			] if backend == 'ffmpeg' else ['soxi', '-D'] if backend == 'sox' else None
+			] if backend in ['ffmpeg', None] else ['soxi', '-D'] if backend == 'sox' else None
 	return float(subprocess.check_output(cmd + [audio_path]))
 
 
+def compute_durations(audio_paths, backend = 'ffmpeg', num_workers = 16, batch_size = 256):
+	# batched fallback prober for files without a parseable header: soxi accepts many files per call, ffprobe does not, so it is run concurrently
+	if backend == 'sox':
+		return [
+			float(duration) for i in range(0, len(audio_paths), batch_size) for duration in
+			subprocess.check_output(['soxi', '-D'] + audio_paths[i:i + batch_size]).split()
+		]
+	with multiprocessing.pool.ThreadPool(num_workers) as pool:
+		return pool.map(functools.partial(compute_duration, backend = backend), audio_paths)
+
+
+def probe_header(audio_path):
+	# returns dict(format, sample_rate, num_channels, num_frames, duration) or None if the header can't be parsed without decoding
+	with open(audio_path, 'rb') as f:
+		head = f.read(10)
+		if head[:3] == b'ID3':
+			# ID3v2 size is a synchsafe integer, the optional footer adds 10 bytes
+			id3_size = 10 + sum((b & 0x7f) << (7 * (3 - i)) for i, b in enumerate(head[6:10])) + (10 if head[5] & 0x10 else 0)
+			f.seek(id3_size)
+			head = f.read(10)
+		else:
+			id3_size = 0
+		f.seek(id3_size)
+		parse = probe_wav if head[:4] in [b'RIFF', b'RF64'] else probe_flac if head[:4] == b'fLaC' else probe_ogg if head[:4] == b'OggS' else probe_mp3 if id3_size > 0 or head[:1] == b'\xff' else None
+		try:
+			info = parse(audio_path, f) if parse is not None else None
+		except (struct.error, AssertionError, ValueError, IndexError, StopIteration, ZeroDivisionError):
+			info = None
+	if info is not None:
+		info['duration'] = info['num_frames'] / info['sample_rate']
+	return info
+
+
+def probe_wav(audio_path, f):
+	header = read_wav_header(audio_path)
+	# compressed WAV payloads (GSM, ADPCM, MP3) have no fixed bytes per frame
+	if header['format_tag'] not in [1, 3]:
+		return None
+	return dict(format = 'wav', sample_rate = header['sample_rate'], num_channels = header['num_channels'], num_frames = header['num_frames'])
+
+
+def probe_flac(audio_path, f):
+	# STREAMINFO is always the first metadata block: 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples
+	magic, block_header, streaminfo = f.read(4), f.read(4), f.read(34)
+	assert block_header[0] & 0x7f == 0 and len(streaminfo) == 34
+	packed = int.from_bytes(streaminfo[10:18], 'big')
+	sample_rate, num_channels, num_frames = packed >> 44, ((packed >> 41) & 0x7) + 1, packed & 0xfffffffff
+	# total samples = 0 means unknown
+	return dict(format = 'flac', sample_rate = sample_rate, num_channels = num_channels, num_frames = num_frames) if num_frames > 0 else None
+
+
+def probe_ogg(audio_path, f, tail_size = 65536):
+	# identification packet is in the first page, the last page granule position is the stream length in samples (at 48 kHz for Opus)
+	page = f.read(27 + 255)
+	serial, num_segments = struct.unpack('<I', page[14:18])[0], page[26]
+	packet = page[27 + num_segments:] + f.read(32)
+	if packet.startswith(b'OpusHead'):
+		# Opus granules always count 48 kHz samples, the header sample rate is only the original input rate (zero if unknown)
+		fmt, num_channels, pre_skip, sample_rate, granule_rate = 'opus', packet[9], struct.unpack('<H', packet[10:12])[0], struct.unpack('<I', packet[12:16])[0] or 48000, 48000
+	elif packet.startswith(b'\x01vorbis'):
+		fmt, num_channels, pre_skip, sample_rate = 'vorbis', packet[11], 0, struct.unpack('<I', packet[12:16])[0]
+		granule_rate = sample_rate
+	else:
+		return None
+
+	file_size = f.seek(0, 2)
+	tail_offset = file_size
+	while tail_offset > 0:
+		tail_offset = max(0, tail_offset - tail_size)
+		f.seek(tail_offset)
+		tail = f.read(tail_size + 27)
+		k = len(tail)
+		while True:
+			k = tail.rfind(b'OggS', 0, k)
+			if k < 0 or k + 27 > len(tail):
+				break
+			granule, serial_ = struct.unpack('<qI', tail[k + 6:k + 18])
+			if serial_ == serial and granule >= 0:
+				num_frames = max(0, granule - pre_skip) * sample_rate // granule_rate
+				return dict(format = fmt, sample_rate = sample_rate, num_channels = num_channels, num_frames = num_frames)
+	return None
+
+
+def probe_mp3(audio_path, f, id3v1_size = 128, search_size = 4096):
+	start = f.tell()
+	buf = f.read(search_size)
+	k = next(i for i in range(len(buf) - 4) if buf[i] == 0xff and buf[i + 1] & 0xe0 == 0xe0 and buf[i + 1] & 0x18 != 0x08 and buf[i + 1] & 0x06 != 0 and buf[i + 2] & 0xf0 != 0xf0 and buf[i + 2] & 0x0c != 0x0c)
+	version, layer, bitrate_index, sample_rate_index, channel_mode = (buf[k + 1] >> 3) & 0x3, 4 - ((buf[k + 1] >> 1) & 0x3), buf[k + 2] >> 4, (buf[k + 2] >> 2) & 0x3, buf[k + 3] >> 6
+	mpeg1 = version == 3
+	sample_rate = [44100, 48000, 32000][sample_rate_index] // (1 if mpeg1 else 2 if version == 2 else 4)
+	samples_per_frame = 384 if layer == 1 else 1152 if layer == 2 or mpeg1 else 576
+	num_channels = 1 if channel_mode == 3 else 2
+	bitrates = mp3_bitrates[(mpeg1, layer if mpeg1 or layer == 1 else 2)]
+
+	# Xing/Info (LAME and most VBR encoders) or VBRI (Fraunhofer) frame carries the exact number of frames
+	xing_offset = k + 4 + ((32 if num_channels == 2 else 17) if mpeg1 else (17 if num_channels == 2 else 9))
+	num_frames = None
+	if buf[xing_offset:xing_offset + 4] in [b'Xing', b'Info']:
+		flags = struct.unpack('>I', buf[xing_offset + 4:xing_offset + 8])[0]
+		if flags & 0x1:
+			num_frames = struct.unpack('>I', buf[xing_offset + 8:xing_offset + 12])[0] * samples_per_frame
+			lame_offset = xing_offset + 8 + 4 * sum(bool(flags & flag) for flag in [0x1, 0x2, 0x8]) + (100 if flags & 0x4 else 0)
+			if buf[lame_offset:lame_offset + 4] == b'LAME' or buf[lame_offset:lame_offset + 4] == b'Lavc':
+				# gapless info: 12 bits encoder delay and 12 bits padding
+				delay_padding = int.from_bytes(buf[lame_offset + 21:lame_offset + 24], 'big')
+				num_frames = max(0, num_frames - (delay_padding >> 12) - (delay_padding & 0xfff))
+	elif buf[k + 36:k + 40] == b'VBRI':
+		num_frames = struct.unpack('>I', buf[k + 50:k + 54])[0] * samples_per_frame
+	if num_frames is None:
+		# constant bitrate: payload size over bitrate, excluding ID3v1 trailer
+		file_size = f.seek(0, 2)
+		f.seek(file_size - id3v1_size)
+		audio_size = file_size - start - k - (id3v1_size if f.read(3) == b'TAG' else 0)
+		num_frames = audio_size * 8 * sample_rate // (bitrates[bitrate_index] * 1000)
+	return dict(format = 'mp3', sample_rate = sample_rate, num_channels = num_channels, num_frames = num_frames)
+
+
+mp3_bitrates = {
+	(True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+	(True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+	(True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+	(False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+	(False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+
+
+class DurationIndex:
+	# persistent {audio_path: [mtime_ns, size, duration]} map, entries are re-probed when a file's mtime or size changes
+	def __init__(self, index_path = None, backend = 'ffmpeg', num_workers = 16):
+		self.index_path = index_path
+		self.backend = backend
+		self.num_workers = num_workers
+		self.index = json.load(gzip.open(index_path, 'rt') if index_path.endswith('.gz') else open(index_path)) if index_path is not None and os.path.exists(index_path) else {}
+		self.dirty = False
+
+	def __getitem__(self, audio_path):
+		return self.lookup([audio_path])[0]
+
+	def lookup(self, audio_paths):
+		audio_paths = list(audio_paths)
+		stats = {audio_path: os.stat(audio_path) for audio_path in set(audio_paths)}
+		missing = [
+			audio_path for audio_path, stat in stats.items()
+			if self.index.get(audio_path, [None, None])[:2] != [stat.st_mtime_ns, stat.st_size]
+		]
+		if missing:
+			durations = {audio_path: compute_duration(audio_path, backend = 'header') for audio_path in missing}
+			unparsed = [audio_path for audio_path, duration in durations.items() if duration is None]
+			if unparsed:
+				durations.update(zip(unparsed, compute_durations(unparsed, backend = self.backend, num_workers = self.num_workers)))
+			self.index.update({audio_path: [stats[audio_path].st_mtime_ns, stats[audio_path].st_size, duration] for audio_path, duration in durations.items()})
+			self.dirty = True
+		return [self.index[audio_path][2] for audio_path in audio_paths]
+
+	def save(self):
+		if self.index_path is None or not self.dirty:
+			return
+		fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.index_path)))
+		with (gzip.open(tmp_path, 'wt') if self.index_path.endswith('.gz') else open(tmp_path, 'w')) as f:
+			json.dump(self.index, f, sort_keys = True)
+		os.close(fd)
+		# mkstemp creates the file as 0600, the index should get the permissions of a regularly created file
+		umask = os.umask(0)
+		os.umask(umask)
+		os.chmod(tmp_path, 0o666 & ~umask)
+		os.replace(tmp_path, self.index_path)
+		self.dirty = False
+
+
 if __name__ == '__main__':
-	import argparse
+	import sys
 	import time
+	import argparse
+	import itertools
+	import resource
 	import utils
 
 	parser = argparse.ArgumentParser()
 	subparsers = parser.add_subparsers()
-	cmd = subparsers.add_parser('timeit')
-
-	cmd.add_argument('--audio-path', type = str, required = True)
+	cmd = subparsers.add_parser('benchmark')
+	cmd.add_argument('--data-dir', default = 'data/tests/read_audio', help = 'synthetic test files are generated here if missing')
+	cmd.add_argument('--formats', nargs = '+', default = ['wav', 'flac', 'ogg', 'opus', 'mp3'])
+	cmd.add_argument('--durations', type = float, nargs = '+', default = [5, 60], help = 'in seconds')
+	cmd.add_argument('--num-channels', type = int, nargs = '+', default = [1, 2])
+	cmd.add_argument('--sample-rate-in', type = int, default = 16000, help = 'sample rate of generated files')
 	cmd.add_argument('--sample-rate', type = int, default = 8000)
-	cmd.add_argument('--mono', action = 'store_true')
-	cmd.add_argument('--audio-backend', type = str, required = True)
-	cmd.add_argument('--number', type = int, default = 100)
-	cmd.add_argument('--number-warmup', type = int, default = 3)
-	cmd.add_argument('--scale', type = int, default = 1000)
-	cmd.add_argument('--raw-dtype', default = 'int16', choices = ['int16', 'float32'])
-	cmd.add_argument('--dtype', default = 'float32', choices = ['int16', 'float32'])
-	cmd.set_defaults(func = 'timeit')
+	cmd.add_argument('--backends', nargs = '+', default = ['mmap', 'scipy', 'soundfile', 'sox', 'ffmpeg', 'pool'])
+	cmd.add_argument('--mono', type = int, nargs = '+', default = [1, 0])
+	cmd.add_argument('--raw-dtypes', nargs = '+', default = ['int16'], choices = ['int16', 'float32'])
+	cmd.add_argument('--dtypes', nargs = '+', default = ['float32'], choices = ['int16', 'float32'])
+	cmd.add_argument('--offsets', type = float, nargs = '+', default = [0.0, 0.5], help = 'as a fraction of file duration')
+	cmd.add_argument('--read-duration', type = float, help = 'in seconds, whole rest of the file if not set')
+	cmd.add_argument('--num-threads', type = int, nargs = '+', default = [1, 4], help = 'concurrent readers')
+	cmd.add_argument('--number', type = int, default = 20, help = 'reads per case')
+	cmd.add_argument('--number-warmup', type = int, default = 2)
+	cmd.add_argument('--output-path', '-o', default = 'data/read_audio_benchmark.json')
+	cmd.add_argument('--baseline', help = 'previously saved benchmark json to diff against')
+	cmd.add_argument('--tolerance', type = float, default = 0.2, help = 'relative slowdown reported as regression')
+	cmd.set_defaults(func = 'benchmark')
+
+	cmd = subparsers.add_parser('resample')
+	cmd.add_argument('--sample-rate-in', type = int, default = 16000)
+	cmd.add_argument('--sample-rate-out', type = int, default = 8000)
+	cmd.add_argument('--batch-size', type = int, default = 16)
+	cmd.add_argument('--num-channels', type = int, default = 1)
+	cmd.add_argument('--duration', type = float, default = 10.0)
+	cmd.add_argument('--device', default = 'cpu')
+	cmd.add_argument('--number', type = int, default = 10)
+	cmd.add_argument('--frequencies', type = float, nargs = '+', default = [200, 1000, 3000])
+	cmd.set_defaults(func = 'resample')
 
 	args = parser.parse_args()
 	
-	if args.func == 'timeit':
+	if args.func == 'benchmark':
 		utils.reset_cpu_threads(1)
-		for i in range(args.number_warmup):
-			read_audio(args.audio_path, sample_rate = args.sample_rate, mono = args.mono, backend = args.audio_backend, dtype = args.dtype, raw_dtype = args.raw_dtype)
-		
-		start_process_time = time.process_time_ns()
-		start_perf_counter = time.perf_counter_ns()
-		for i in range(args.number):
-			read_audio(args.audio_path, sample_rate = args.sample_rate, mono = args.mono, backend = args.audio_backend, dtype = args.dtype, raw_dtype = args.raw_dtype)
-		end_process_time = time.process_time_ns()
-		end_perf_counter = time.perf_counter_ns()
-		process_time = (end_process_time - start_process_time) / args.scale / args.number
-		perf_counter = (end_perf_counter - start_perf_counter) / args.scale / args.number
-		print(f'|{args.audio_path:>20}|{args.number:>5}|{args.audio_backend:>10}|{process_time:9.0f}|{perf_counter:9.0f}|')
+		os.makedirs(args.data_dir, exist_ok = True)
+		subtypes = dict(wav = ('WAV', 'PCM_16'), flac = ('FLAC', 'PCM_16'), ogg = ('OGG', 'VORBIS'), opus = ('OGG', 'OPUS'), mp3 = ('MP3', None))
+		case_keys = ['format', 'file_duration', 'file_num_channels', 'backend', 'mono', 'raw_dtype', 'dtype', 'offset', 'num_threads']
+
+		audio_paths = {}
+		for fmt, file_duration, num_channels in itertools.product(args.formats, args.durations, args.num_channels):
+			audio_path = audio_paths[fmt, file_duration, num_channels] = os.path.join(args.data_dir, f'test_{file_duration:g}s_{num_channels}ch.{fmt}')
+			if not os.path.exists(audio_path):
+				t = np.arange(int(file_duration * args.sample_rate_in)) / args.sample_rate_in
+				signal = np.stack([0.5 * np.sin(2 * np.pi * 440 * (c + 1) * t) + 0.01 * np.random.randn(len(t)) for c in range(num_channels)], axis = 1)
+				soundfile.write(audio_path, signal.astype('float32'), args.sample_rate_in, format = subtypes[fmt][0], subtype = subtypes[fmt][1])
+
+		class FallbackError(Exception):
+			pass
+
+		def run_case(audio_path, file_duration, backend, mono, raw_dtype, dtype, offset, num_threads):
+			read = lambda _: (time.perf_counter(), read_audio(audio_path, sample_rate = args.sample_rate, offset = offset * file_duration, duration = args.read_duration, mono = mono, backend = backend, raw_dtype = raw_dtype, dtype = dtype)[0].shape[-1], time.perf_counter())
+			for i in range(args.number_warmup):
+				read(i)
+			# peak RSS is reset (Linux only) so the high-water mark belongs to this case alone
+			if os.path.exists('/proc/self/clear_refs'):
+				with open('/proc/self/clear_refs', 'w') as f:
+					f.write('5')
+			num_fallbacks = decoder_pool.num_fallbacks
+			start_process_time, start_perf_counter = time.process_time(), time.perf_counter()
+			with multiprocessing.pool.ThreadPool(num_threads) as pool:
+				reads = pool.map(read, range(args.number))
+			process_time, perf_counter = time.process_time() - start_process_time, time.perf_counter() - start_perf_counter
+			if decoder_pool.num_fallbacks != num_fallbacks:
+				# the numbers would be ffmpeg's, not the pool's
+				raise FallbackError(f'{decoder_pool.num_fallbacks - num_fallbacks} of {args.number} reads fell back to ffmpeg')
+			latency = [(end - begin) * 1000 for begin, num_samples, end in reads]
+			return dict(
+				p50_ms = float(np.percentile(latency, 50)),
+				p95_ms = float(np.percentile(latency, 95)),
+				audio_sec_per_sec = sum(num_samples for begin, num_samples, end in reads) / args.sample_rate / perf_counter,
+				cpu_ms = process_time * 1000 / args.number,
+				peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+			)
+
+		print('| format | file sec | file ch | backend | mono | raw dtype | dtype | offset | threads | p50 ms | p95 ms | audio sec/sec | cpu ms | peak rss mb |')
+		print('|-------:|---------:|--------:|--------:|-----:|----------:|------:|-------:|--------:|-------:|-------:|--------------:|-------:|------------:|')
+		results = []
+		for (fmt, file_duration, num_channels), backend, mono, raw_dtype, dtype, offset, num_threads in itertools.product(audio_paths, args.backends, args.mono, args.raw_dtypes, args.dtypes, args.offsets, args.num_threads):
+			case = dict(zip(case_keys, [fmt, file_duration, num_channels, backend, bool(mono), raw_dtype, dtype, offset, num_threads]))
+			results.append(case)
+			try:
+				case.update(run_case(audio_paths[fmt, file_duration, num_channels], file_duration, backend, bool(mono), raw_dtype, dtype, offset, num_threads))
+			except Exception as e:
+				# e.g. scipy on compressed formats, missing sox/ffmpeg binaries, int16 output with downmixing
+				case['error'] = f'{type(e).__name__}: {e}'
+				if isinstance(e, FallbackError):
+					print('FALLBACK', ' '.join(f'{k}={case[k]}' for k in case_keys), case['error'])
+				continue
+			print('|' + '|'.join(f'{str(case[k]):>7}' for k in case_keys) + f'|{case["p50_ms"]:8.2f}|{case["p95_ms"]:8.2f}|{case["audio_sec_per_sec"]:15.1f}|{case["cpu_ms"]:8.2f}|{case["peak_rss_mb"]:13.1f}|')
+
+		json.dump(results, open(args.output_path, 'w'), indent = 2)
+		print(args.output_path, '|', sum('error' not in case for case in results), 'cases |', sum('error' in case for case in results), 'skipped')
+		fallbacks = [case for case in results if case.get('error', '').startswith(FallbackError.__name__)]
+		if fallbacks:
+			print(len(fallbacks), 'cases fell back to ffmpeg')
+
+		if args.baseline:
+			baseline = {tuple(case[k] for k in case_keys): case for case in json.load(open(args.baseline)) if 'error' not in case}
+			regressions = []
+			for case in results:
+				case_ = baseline.get(tuple(case[k] for k in case_keys))
+				if case_ is None or 'error' in case:
+					continue
+				slowdown = dict(p50_ms = case['p50_ms'] / case_['p50_ms'], p95_ms = case['p95_ms'] / case_['p95_ms'], audio_sec_per_sec = case_['audio_sec_per_sec'] / case['audio_sec_per_sec'], peak_rss_mb = case['peak_rss_mb'] / case_['peak_rss_mb'])
+				regressions.extend((case, metric, ratio) for metric, ratio in slowdown.items() if ratio > 1 + args.tolerance)
+			for case, metric, ratio in regressions:
+				print('REGRESSION', ' '.join(f'{k}={case[k]}' for k in case_keys), f'{metric} x{ratio:.2f}')
+			print(args.baseline, '|', len(regressions), 'regressions')
+			sys.exit(1 if regressions or fallbacks else 0)
+		sys.exit(1 if fallbacks else 0)
+
+	if args.func == 'resample':
+		# sum of sines is known analytically at both sample rates, so both resamplers are scored against the exact signal
+		sines = lambda sample_rate: sum(
+			np.sin(2 * np.pi * f * np.arange(int(args.duration * sample_rate)) / sample_rate + k)
+			for k, f in enumerate(args.frequencies)
+		).astype('float32') / len(args.frequencies)
+		signal_in, signal_out = sines(args.sample_rate_in), sines(args.sample_rate_out)
+		batch = torch.as_tensor(signal_in).repeat(args.batch_size, args.num_channels, 1)
+		margin = slice(args.sample_rate_out // 10, -(args.sample_rate_out // 10))
+		synchronize = lambda: torch.cuda.synchronize() if 'cuda' in args.device else None
+
+		resamplers = dict(
+			librosa = lambda batch: np.stack([librosa.resample(signal, orig_sr = args.sample_rate_in, target_sr = args.sample_rate_out) for signal in batch.reshape(-1, batch.shape[-1]).numpy()]),
+			torch = lambda batch: resample(batch.to(args.device), args.sample_rate_in, args.sample_rate_out)[0].reshape(-1, len(signal_out)).cpu().numpy()
+		)
+		print('| resampler | device | batch | in Hz | out Hz | msec per batch | max abs error |')
+		print('|----------:|-------:|------:|------:|-------:|---------------:|--------------:|')
+		for name, resampler in resamplers.items():
+			resampled = resampler(batch)
+			synchronize()
+			tic = time.perf_counter()
+			for i in range(args.number):
+				resampler(batch)
+			synchronize()
+			msec = (time.perf_counter() - tic) * 1000 / args.number
+			error = np.abs(resampled[:, margin] - signal_out[margin]).max()
+			print(f'|{name:>11}|{args.device if name == "torch" else "cpu":>8}|{len(resampled):>7}|{args.sample_rate_in:>7}|{args.sample_rate_out:>8}|{msec:16.2f}|{error:15.2e}|')
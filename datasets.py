@@ -4,12 +4,21 @@ import os
 import gzip
 import math
 import json
+import random
+import threading
+import queue as Queue
+import shutil
+import hashlib
+import zlib
+import tempfile
 import itertools
 import functools
 import importlib
+import numpy as np
 import torch.utils.data
 import sentencepiece
 import audio
+import shards
 import utils
 import transcripts
 
@@ -17,6 +26,244 @@ def worker_init_fn(worker_id, num_threads = 1):
 	utils.set_random_seed(worker_id)
 	utils.reset_cpu_threads(num_threads)
 
+class ManifestIndex:
+	# columnar manifest: one row per utterance, an example is a contiguous range of rows, strings are stored in utf-8 tables.
+	# Arrays are cached as .npy next to the json and memory-mapped, so startup skips json parsing and forked DataLoader workers
+	# share the pages instead of copying millions of python dicts touched by refcounting
+	version = 2
+	string_columns = ['audio_path', 'ref', 'extra']
+
+	def __init__(self, arrays, example_idx = None):
+		self.arrays = arrays
+		self.example_idx = example_idx
+
+	def __len__(self):
+		return len(self.example_idx) if self.example_idx is not None else len(self.arrays['example_offsets']) - 1
+
+	def __getitem__(self, idx):
+		idx = int(self.example_idx[idx]) if self.example_idx is not None else idx
+		example_offsets = self.arrays['example_offsets']
+		return [self.row(i) for i in range(example_offsets[idx], example_offsets[idx + 1])]
+
+	@property
+	def duration(self):
+		return self.arrays['duration'][self.example_idx] if self.example_idx is not None else self.arrays['duration']
+
+	def select(self, example_idx):
+		return ManifestIndex(self.arrays, example_idx if self.example_idx is None else self.example_idx[example_idx])
+
+	def string(self, column, i):
+		return self.table_string(column, self.arrays[column][i])
+
+	def table_string(self, column, k):
+		offsets = self.arrays[column + '_offsets']
+		return bytes(self.arrays[column + '_data'][offsets[k]:offsets[k + 1]]).decode('utf-8') if k >= 0 else None
+
+	def encoded(self, idx, labels):
+		# normalized reference and targets of the first row of an example, precomputed per distinct ref by encode_refs
+		idx = int(self.example_idx[idx]) if self.example_idx is not None else idx
+		key = ManifestIndex.labels_key(labels)
+		k = self.arrays['ref'][self.arrays['example_offsets'][idx]]
+		if k < 0 or key + '_targets' not in self.arrays:
+			return None
+		offsets = self.arrays[key + '_targets_offsets']
+		return self.table_string(key + '_normalized', k), torch.from_numpy(self.arrays[key + '_targets'][offsets[k]:offsets[k + 1]].astype(np.int64))
+
+	@staticmethod
+	def labels_key(labels):
+		return 'labels_' + labels.digest()[:16]
+
+	def encode_refs(self, labels):
+		# normalization and encoding run once per distinct ref string, results are aligned with the ref string table
+		key = ManifestIndex.labels_key(labels)
+		if key + '_targets' in self.arrays:
+			return []
+		encoded = [labels.encode(self.table_string('ref', k)) for k in range(len(self.arrays['ref_offsets']) - 1)]
+		normalized = [normalized.encode('utf-8') for normalized, targets in encoded]
+		self.arrays[key + '_normalized_offsets'] = np.cumsum([0] + list(map(len, normalized)), dtype = np.int64)
+		self.arrays[key + '_normalized_data'] = np.frombuffer(b''.join(normalized), dtype = np.uint8)
+		self.arrays[key + '_targets_offsets'] = np.cumsum([0] + [len(targets) for normalized, targets in encoded], dtype = np.int64)
+		self.arrays[key + '_targets'] = np.concatenate([np.zeros(0, dtype = np.int32)] + [targets.numpy().astype(np.int32) for normalized, targets in encoded])
+		return [key + '_normalized_offsets', key + '_normalized_data', key + '_targets_offsets', key + '_targets']
+
+	def row(self, i):
+		begin, end, channel, ref, extra = self.arrays['begin'][i], self.arrays['end'][i], self.arrays['channel'][i], self.string('ref', i), self.string('extra', i)
+		t = dict(audio_path = self.string('audio_path', i))
+		# integer begin/end are kept as int, like in the json
+		t.update(dict(begin = int(begin) if self.arrays['begin_int'][i] else float(begin)) if not np.isnan(begin) else {})
+		t.update(dict(end = int(end) if self.arrays['end_int'][i] else float(end)) if not np.isnan(end) else {})
+		t.update(dict(channel = int(channel)) if channel >= 0 else {})
+		t.update(dict(ref = ref) if ref is not None else {})
+		t.update(json.loads(extra) if extra is not None else {})
+		return t
+
+	@staticmethod
+	def build(examples):
+		rows = [t for example in examples for t in example]
+		is_number = lambda x: isinstance(x, (int, float)) and not isinstance(x, bool)
+		in_column = lambda k, v: k == 'audio_path' or (k in ['begin', 'end'] and is_number(v)) or (k == 'channel' and isinstance(v, int) and not isinstance(v, bool) and v >= 0) or (k == 'ref' and isinstance(v, str))
+		tables = {column: {} for column in ManifestIndex.string_columns}
+		string_idx = lambda column, s: tables[column].setdefault(s, len(tables[column])) if s is not None else -1
+
+		arrays = dict(
+			audio_path = np.array([string_idx('audio_path', t.get('audio_path')) for t in rows], dtype = np.int64),
+			begin = np.array([t['begin'] if is_number(t.get('begin')) else np.nan for t in rows], dtype = np.float64),
+			end = np.array([t['end'] if is_number(t.get('end')) else np.nan for t in rows], dtype = np.float64),
+			begin_int = np.array([isinstance(t.get('begin'), int) and not isinstance(t.get('begin'), bool) for t in rows], dtype = bool),
+			end_int = np.array([isinstance(t.get('end'), int) and not isinstance(t.get('end'), bool) for t in rows], dtype = bool),
+			channel = np.array([t['channel'] if in_column('channel', t.get('channel')) else -1 for t in rows], dtype = np.int16),
+			ref = np.array([string_idx('ref', t['ref'] if in_column('ref', t.get('ref')) else None) for t in rows], dtype = np.int64),
+			extra = np.array([
+				string_idx('extra', json.dumps(extra, ensure_ascii = False, sort_keys = True) if extra else None) for t in rows
+				for extra in [{k: v for k, v in t.items() if not in_column(k, v)}]
+			], dtype = np.int64),
+			example_offsets = np.cumsum([0] + [len(example) for example in examples], dtype = np.int64)
+		)
+		# summed sequentially like transcripts.compute_duration, so ties sort exactly as before
+		seconds = (np.nan_to_num(arrays['end']) - np.nan_to_num(arrays['begin'])).tolist()
+		arrays['duration'] = np.array([sum(seconds[begin:end]) for begin, end in zip(arrays['example_offsets'][:-1], arrays['example_offsets'][1:])], dtype = np.float64)
+		for column, table in tables.items():
+			encoded = [s.encode('utf-8') for s in table]
+			arrays[column + '_offsets'] = np.cumsum([0] + list(map(len, encoded)), dtype = np.int64)
+			arrays[column + '_data'] = np.frombuffer(b''.join(encoded), dtype = np.uint8)
+		return ManifestIndex(arrays)
+
+	@staticmethod
+	def cat(indexes):
+		if len(indexes) == 0:
+			return ManifestIndex.build([])
+		if len(indexes) == 1:
+			return indexes[0]
+		arrays = {name: np.concatenate([index.arrays[name] for index in indexes]) for name in ['begin', 'end', 'begin_int', 'end_int', 'channel', 'duration']}
+		arrays['example_offsets'] = np.concatenate([[0]] + [index.arrays['example_offsets'][1:] + sum(len(index_.arrays['begin']) for index_ in indexes[:k]) for k, index in enumerate(indexes)])
+		for column in ManifestIndex.string_columns:
+			num_strings = [len(index.arrays[column + '_offsets']) - 1 for index in indexes]
+			num_bytes = [len(index.arrays[column + '_data']) for index in indexes]
+			arrays[column] = np.concatenate([np.where(index.arrays[column] >= 0, index.arrays[column] + sum(num_strings[:k]), -1) for k, index in enumerate(indexes)])
+			arrays[column + '_offsets'] = np.concatenate([[0]] + [index.arrays[column + '_offsets'][1:] + sum(num_bytes[:k]) for k, index in enumerate(indexes)])
+			arrays[column + '_data'] = np.concatenate([index.arrays[column + '_data'] for index in indexes])
+		# precomputed targets are aligned with the ref string table, so they concatenate the same way
+		for key in set.intersection(*[set(name[:-len('_targets')] for name in index.arrays if name.startswith('labels_') and name.endswith('_targets')) for index in indexes]):
+			for column in [key + '_normalized_offsets', key + '_targets_offsets']:
+				num_items = [int(index.arrays[column][-1]) for index in indexes]
+				arrays[column] = np.concatenate([[0]] + [index.arrays[column][1:] + sum(num_items[:k]) for k, index in enumerate(indexes)])
+			for column in [key + '_normalized_data', key + '_targets']:
+				arrays[column] = np.concatenate([index.arrays[column] for index in indexes])
+		return ManifestIndex(arrays)
+
+	@staticmethod
+	def in_shard(t, shard):
+		# (rank, world_size): utterances are assigned by a stable hash of audio_path, so examples grouped by audio_path stay whole
+		rank, world_size = shard
+		return zlib.crc32(str(t.get('audio_path')).encode('utf-8')) % world_size == rank
+
+	@staticmethod
+	def read(data_path, duration_index = None, labels = [], shard = None):
+		transcript_path = data_path + '.json' if '.json' not in data_path else data_path
+		if not os.path.exists(transcript_path):
+			# a bare audio file is a single example, it is not sharded
+			index = ManifestIndex.build([fill_duration([dict(audio_path = data_path)], duration_index)])
+			for labels_ in labels:
+				index.encode_refs(labels_)
+			return index
+
+		index_dir = transcript_path + '.index' + ('.{}-of-{}'.format(*shard) if shard is not None else '')
+		stat = os.stat(transcript_path)
+		# ends filled from the duration index are baked into the cached arrays, so an index built without it is not reused with it
+		meta = dict(version = ManifestIndex.version, mtime_ns = stat.st_mtime_ns, size = stat.st_size, shard = list(shard) if shard is not None else None, duration_index = duration_index is not None)
+		meta_path = os.path.join(index_dir, 'meta.json')
+		if os.path.exists(meta_path) and json.load(open(meta_path)) == meta:
+			index = ManifestIndex.load(index_dir)
+			try:
+				index.save_arrays(index_dir, sum([index.encode_refs(labels_) for labels_ in labels], []))
+			except OSError:
+				pass
+			return index
+
+		# with a shard, utterances of other ranks are dropped while parsing, so neither they nor their durations are kept
+		transcript = json.load(gzip.open(transcript_path, 'rt') if transcript_path.endswith('.gz') else open(transcript_path)) if shard is None else [t for t in iter_manifest(transcript_path) if ManifestIndex.in_shard(t, shard)]
+		transcript = fill_duration(transcript, duration_index)
+		index = ManifestIndex.build([list(g) for k, g in itertools.groupby(sorted(transcript, key = transcripts.sort_key), key = transcripts.group_key)])
+		for labels_ in labels:
+			index.encode_refs(labels_)
+		try:
+			index.save(index_dir, meta)
+		except OSError:
+			# read-only dataset dir, the index is rebuilt in memory every time
+			pass
+		return index
+
+	def save(self, index_dir, meta):
+		tmp_dir = tempfile.mkdtemp(dir = os.path.dirname(os.path.abspath(index_dir)))
+		for name, array in self.arrays.items():
+			np.save(os.path.join(tmp_dir, name + '.npy'), array)
+		json.dump(meta, open(os.path.join(tmp_dir, 'meta.json'), 'w'))
+		shutil.rmtree(index_dir, ignore_errors = True)
+		try:
+			os.rename(tmp_dir, index_dir)
+		except OSError:
+			# another process has just written the same index
+			shutil.rmtree(tmp_dir, ignore_errors = True)
+
+	def save_arrays(self, index_dir, names):
+		# columns added to an existing index (e.g. targets for another label set), each file is replaced atomically
+		for name in names:
+			fd, tmp_path = tempfile.mkstemp(dir = index_dir, suffix = '.npy.tmp')
+			with os.fdopen(fd, 'wb') as f:
+				np.save(f, self.arrays[name])
+			os.replace(tmp_path, os.path.join(index_dir, name + '.npy'))
+
+	@staticmethod
+	def load(index_dir):
+		return ManifestIndex({
+			os.path.splitext(file_name)[0]: np.load(os.path.join(index_dir, file_name), mmap_mode = 'r')
+			for file_name in os.listdir(index_dir) if file_name.endswith('.npy')
+		})
+
+
+class FeatureCache:
+	# float16 frontend outputs of unaugmented examples (e.g. validation sets), one memory-mapped .npy per example,
+	# stored under a directory named by the digest of the frontend config and buffers (window, mel basis)
+	def __init__(self, cache_dir, frontend):
+		self.cache_dir = os.path.join(cache_dir, FeatureCache.frontend_digest(frontend))
+
+	@staticmethod
+	def frontend_digest(frontend):
+		frontend = getattr(frontend, 'frontend', frontend)
+		config = {k: v for k, v in vars(frontend).items() if k != 'training' and isinstance(v, (bool, int, float, str, type(None)))}
+		digest = hashlib.sha1(repr((frontend.__class__.__name__, sorted(config.items()))).encode('utf-8'))
+		for k, v in frontend.state_dict().items():
+			digest.update(k.encode('utf-8') + v.cpu().numpy().tobytes())
+		return digest.hexdigest()
+
+	def path(self, t, sample_rate, mono, duration):
+		stat = os.stat(t.get('shard_path', t['audio_path']))
+		key = (os.path.abspath(t['audio_path']), stat.st_mtime_ns, stat.st_size, t.get('shard_offset'), t.get('shard_length'), sample_rate, bool(mono), duration)
+		digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+		return os.path.join(self.cache_dir, digest[:2], digest + '.npy')
+
+	def read(self, cache_path):
+		try:
+			return torch.from_numpy(np.load(cache_path, mmap_mode = 'r').astype(np.float32))
+		except FileNotFoundError:
+			return None
+
+	def write(self, cache_path, features):
+		os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+		fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(cache_path), suffix = '.npy')
+		with os.fdopen(fd, 'wb') as f:
+			np.save(f, features.detach().cpu().numpy().astype(np.float16))
+		os.replace(tmp_path, cache_path)
+
+
+def fill_duration(transcript, duration_index = None):
+	# transcripts without an end (e.g. bare audio files) get the file duration from the index for sorting and filtering
+	no_end = [t for t in transcript if 'end' not in t] if duration_index is not None else []
+	for t, end in zip(no_end, duration_index.lookup(t['audio_path'] for t in no_end) if no_end else []):
+		t['end'] = end
+	return transcript
+
+
 class AudioTextDataset(torch.utils.data.Dataset):
 	def __init__(
 		self,
@@ -37,7 +284,13 @@ class AudioTextDataset(torch.utils.data.Dataset):
 		time_padding_multiple = 1,
 		audio_backend = None,
 		exclude = set(),
-		join_transcript = False
+		join_transcript = False,
+		audio_cache = None,
+		duration_index = None,
+		feature_cache = None,
+		shard = None,
+		batch_feature_transform = None,
+		device = None
 	):
 		self.join_transcript = join_transcript
 		self.max_duration = max_duration
@@ -49,31 +302,32 @@ class AudioTextDataset(torch.utils.data.Dataset):
 		self.time_padding_multiple = time_padding_multiple
 		self.mono = mono
 		self.audio_backend = audio_backend
+		self.audio_cache = audio_cache
 		self.speakers = speakers
+		# pinned buffers are reused only when batches are copied to a cuda device, on cpu callers keep batch tensors (e.g. evaluate_model)
+		self.collate_buffers = CollateBuffers(pin_memory = device is not None and torch.device(device).type == 'cuda')
+		# spectral augmentation of whole collated feature batches, see transforms.SpecAugment
+		self.batch_feature_transform = batch_feature_transform
+		# cached features are only valid for deterministic frontends, i.e. without waveform or feature augmentation
+		self.feature_cache = feature_cache if frontend is not None and getattr(frontend, 'waveform_transform', None) is None and getattr(frontend, 'feature_transform', None) is None else None
 
-		gzopen = lambda data_path: gzip.open(data_path, 'rt') if data_path.endswith('.gz') else open(data_path)
-		duration = lambda example: sum(map(transcripts.compute_duration, example))
 		data_paths = data_paths if isinstance(data_paths, list) else [data_paths]
 
-		def read_transcript(data_path):
-			transcript_path = data_path + '.json' if '.json' not in data_path else data_path
-			return json.load(gzopen(transcript_path)
-								) if os.path.exists(transcript_path) else [dict(audio_path = data_path)]
-
-		self.examples = [
-			list(g) for data_path in data_paths for k,
-			g in itertools
-			.groupby(sorted(read_transcript(data_path), key = transcripts.sort_key), key = transcripts.group_key)
-		]
-		self.examples = sorted(self.examples, key = duration)
-		self.examples = list(
-			filter(
-				lambda example: (min_duration is None or min_duration <= duration(example)) and
-				(max_duration is None or duration(example) <= max_duration),
-				self.examples
-			)
-		) if duration_filter else self.examples
-		self.examples = [e for e in self.examples if transcripts.audio_name(e[0]) not in exclude]
+		# normalized references and targets of the whole-utterance mode are precomputed in the index and shared by all epochs and workers
+		# with shard = (rank, world_size) every rank parses and indexes only its own utterances, see ManifestIndex.in_shard
+		index = ManifestIndex.cat([ManifestIndex.read(data_path, duration_index = duration_index, labels = labels if not segmented else [], shard = shard) for data_path in data_paths])
+		if duration_index is not None:
+			duration_index.save()
+		example_idx = np.argsort(index.duration, kind = 'stable')
+		duration = index.duration[example_idx]
+		if duration_filter:
+			keep = np.ones(len(example_idx), dtype = bool)
+			keep &= (min_duration <= duration) if min_duration is not None else True
+			keep &= (duration <= max_duration) if max_duration is not None else True
+			example_idx = example_idx[keep]
+		if exclude:
+			example_idx = np.array([i for i in example_idx if transcripts.audio_name(index[i][0]) not in exclude], dtype = np.int64)
+		self.examples = index.select(example_idx)
 		'''
 		def safe_coding_for_audio_lenghts:
 			duration = max(transcripts.compute_duration(t, hours=True) for t in meta)
@@ -84,7 +338,9 @@ class AudioTextDataset(torch.utils.data.Dataset):
 		'''
 
 	def __getitem__(self, index):
-		transcript = self.examples[index]
+		return self.load_example(self.examples[index], encoded = lambda labels: self.examples.encoded(index, labels))
+
+	def load_example(self, transcript, encoded = lambda labels: None):
 		audio_path = transcript[0]['audio_path']
 
 		waveform_transform_debug = (
@@ -97,23 +353,39 @@ class AudioTextDataset(torch.utils.data.Dataset):
 			)
 		) if self.waveform_transform_debug_dir else None
 
+		# utterances packed into shards (tools.py cut --shards) are read by sample offset instead of opening audio_path
+		read_audio = lambda t, offset = 0, duration = self.max_duration: shards.read_audio(t['shard_path'], t['shard_offset'], t['shard_length'], sample_rate = self.sample_rate, mono = self.mono, duration = duration) if 'shard_path' in t else \
+			audio.read_audio(t['audio_path'], sample_rate = self.sample_rate, mono = self.mono, backend = self.audio_backend, offset = offset, duration = duration, cache = self.audio_cache)
+
 		if not self.segmented:
 			transcript = transcript[0]
-			signal, sample_rate = audio.read_audio(audio_path, sample_rate = self.sample_rate, mono = self.mono, backend = self.audio_backend, duration=self.max_duration) if self.frontend is None or self.frontend.read_audio else (audio_path, self.sample_rate)
+			feature_cache_path = self.feature_cache.path(transcript, self.sample_rate, self.mono, self.max_duration) if self.feature_cache is not None else None
+			features = self.feature_cache.read(feature_cache_path) if feature_cache_path is not None else None
+			if features is None:
+				signal, sample_rate = read_audio(transcript) if self.frontend is None or self.frontend.read_audio else (audio_path, self.sample_rate)
+				features = self.frontend(signal, waveform_transform_debug = waveform_transform_debug
+											).squeeze(0) if self.frontend is not None else signal
+				if feature_cache_path is not None:
+					self.feature_cache.write(feature_cache_path, features)
 
 			transcript = dict(dict(audio_name = os.path.basename(transcript['audio_path'])), **transcript)
-			features = self.frontend(signal, waveform_transform_debug = waveform_transform_debug
-										).squeeze(0) if self.frontend is not None else signal
-			targets = [labels.encode(transcript['ref']) for labels in self.labels]
+			targets = [encoded(labels) or labels.encode(transcript['ref']) for labels in self.labels]
 			ref_normalized, targets = zip(*targets)
 		else:
-			signal, sample_rate = audio.read_audio(audio_path, sample_rate = self.sample_rate, mono = self.mono, backend = self.audio_backend, duration=self.max_duration)
 			replace_transcript = self.join_transcript or \
                                not transcript or \
                                (any(t.get('begin') is None and t.get('end') is None for t in transcript) and \
                                 all(t.get('ref') is not None for t in transcript))
 			normalize_text = True
 
+			# segments with known boundaries are decoded range by range (nearby segments merged), not as the whole recording
+			is_number = lambda x: isinstance(x, (int, float))
+			ranges = self.segment_ranges(transcript) if not replace_transcript and 'shard_path' not in transcript[0] and all(
+				is_number(t.get('begin')) and is_number(t.get('end')) for t in transcript
+			) else [(0, self.max_duration)]
+			chunks = [(begin, ) + read_audio(transcript[0], offset = begin, duration = duration) for begin, duration in ranges]
+			signal, sample_rate = chunks[0][1:]
+
 			if replace_transcript:
 				assert len(signal) == 1
 				ref_full = [self.labels[0].normalize_text(t['ref']) for t in transcript]
@@ -140,11 +412,14 @@ class AudioTextDataset(torch.utils.data.Dataset):
 				for t in sorted(transcript, key = transcripts.sort_key)
 				for channel in ([t['channel']] if 'channel' in t else range(len(signal)))
 			]
+			# range offsets are whole seconds, so sample indices within a range match slicing of the whole recording
+			chunk = lambda t: next(chunk for chunk in reversed(chunks) if chunk[0] <= t['begin'])
 			features = [
 				self.frontend(segment, waveform_transform_debug = waveform_transform_debug).squeeze(0)
 				if self.frontend is not None else segment.unsqueeze(0)
 				for t in transcript
-				for segment in [signal[t['channel'], int(t['begin'] * sample_rate):1 + int(t['end'] * sample_rate)]]
+				for begin, signal, sample_rate in [chunk(t)]
+				for segment in [signal[t['channel'], int(t['begin'] * sample_rate) - begin * sample_rate:1 + int(t['end'] * sample_rate) - begin * sample_rate]]
 			]
 			targets = [[labels.encode(t.get('ref', ''), normalize = normalize_text)[1]
 						for t in transcript]
@@ -152,6 +427,19 @@ class AudioTextDataset(torch.utils.data.Dataset):
 
 		return [transcript, features] + list(targets)
 
+	def segment_ranges(self, transcript, merge_gap = 1.0, margin = 0.1):
+		# merged [begin, end) time ranges covering all segments, with begin floored to whole seconds, returned as (begin, duration)
+		ranges = []
+		for t in sorted(transcript, key = lambda t: t['begin']):
+			begin, end = int(max(t['begin'] - margin, 0)), t['end'] + margin
+			if self.max_duration is not None:
+				end = min(end, self.max_duration)
+			if ranges and begin <= ranges[-1][1] + merge_gap:
+				ranges[-1][1] = max(ranges[-1][1], end)
+			else:
+				ranges.append([begin, end])
+		return [(begin, max(end - begin, 0)) for begin, end in ranges] or [(0, self.max_duration)]
+
 	def __len__(self):
 		return len(self.examples)
 
@@ -161,54 +449,295 @@ class AudioTextDataset(torch.utils.data.Dataset):
 
 		meta, sample_x, *sample_y = batch[0]
 		xmax_len, *ymax_len = [int(math.ceil(max(b[k].shape[-1] for b in batch) / self.time_padding_multiple)) * self.time_padding_multiple for k in range(1, len(batch[0]))]
-		x = torch.zeros(len(batch), len(sample_x), xmax_len, dtype = sample_x.dtype)
-		y = torch.zeros(len(batch), len(sample_y), max(ymax_len), dtype = torch.long)
-		xlen, ylen = torch.zeros(len(batch), dtype = torch.float32), torch.zeros(len(batch), len(sample_y), dtype = torch.long)
+		x = self.collate_buffers.empty('x', (len(batch), len(sample_x), xmax_len), sample_x.dtype)
+		y = self.collate_buffers.empty('y', (len(batch), len(sample_y), max(ymax_len)), torch.long).zero_()
+		xlen = torch.tensor([b[1].shape[-1] for b in batch], dtype = torch.float32) / x.shape[-1] if x.shape[-1] > 0 else torch.ones(len(batch), dtype = torch.float32)
+		ylen = torch.tensor([[len(t) for t in b[2:]] for b in batch], dtype = torch.long).view(len(batch), len(sample_y))
 		for k, (meta, sample_x, *sample_y) in enumerate(batch):
-			xlen[k] = sample_x.shape[-1] / x.shape[-1] if x.shape[-1] > 0 else 1.0
+			# buffers are reused, so only the padding tail is zeroed
 			x[k, ..., :sample_x.shape[-1]] = sample_x
-			for j, t in enumerate(sample_y):
-				y[k, j, :t.shape[-1]] = t
-				ylen[k, j] = len(t)
+			x[k, ..., sample_x.shape[-1]:] = 0
+		# targets are tiny, a single masked copy is much cheaper than a python loop over examples and label sets
+		y.masked_scatter_(torch.arange(y.shape[-1]) < ylen.unsqueeze(-1), torch.cat([t.to(torch.long) for b in batch for t in b[2:]] or [torch.zeros(0, dtype = torch.long)]))
+		if self.batch_feature_transform is not None:
+			x = self.batch_feature_transform(x, self.sample_rate, xlen = xlen)[0]
 
 		return tuple(zip(*batch))[:1] + (x, xlen, y, ylen)
 
 
+class StreamingAudioTextDataset(AudioTextDataset, torch.utils.data.IterableDataset):
+	# for manifests that do not fit in memory: json/jsonl (optionally gzipped) manifests are parsed lazily, every DataLoader worker of every rank
+	# keeps every (world_size * num_workers)-th utterance, passes it through a bounded shuffle buffer and groups it into length buckets.
+	# Yields whole batches (use DataLoader(batch_size = None)) and plays the sampler role in train.py: shuffle(epoch), batch_idx, state_dict
+	def __init__(
+		self,
+		data_paths,
+		labels,
+		sample_rate,
+		bucket,
+		batch_size = 1,
+		batch_duration = None,
+		shuffle_buffer_size = 2**16,
+		rank = 0,
+		world_size = 1,
+		min_duration = None,
+		max_duration = None,
+		duration_index = None,
+		**kwargs
+	):
+		super().__init__([], labels, sample_rate, min_duration = min_duration, max_duration = max_duration, **kwargs)
+		self.data_paths = data_paths if isinstance(data_paths, list) else [data_paths]
+		self.min_duration = min_duration
+		self.bucket = bucket
+		self.batch_size = batch_size
+		self.batch_duration = batch_duration
+		self.shuffle_buffer_size = shuffle_buffer_size
+		self.rank = rank
+		self.world_size = world_size
+		self.duration_index = duration_index
+		self.epoch = 0
+		self.batch_idx = 0
+
+	def __len__(self):
+		raise TypeError('StreamingAudioTextDataset has no length')
+
+	def shuffle(self, epoch):
+		self.epoch = epoch
+
+	def state_dict(self):
+		return dict(batch_idx = self.batch_idx)
+
+	def load_state_dict(self, state_dict):
+		self.batch_idx = state_dict['batch_idx']
+
+	def __iter__(self):
+		worker_info = torch.utils.data.get_worker_info()
+		worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+		shard, num_shards = self.rank * num_workers + worker_id, self.world_size * num_workers
+		rng = random.Random(hash((self.epoch, shard)))
+		# the DataLoader takes batches from workers round-robin, so a resumed epoch skips this worker's share of the first batch_idx batches
+		skip = (self.batch_idx - worker_id + num_workers - 1) // num_workers
+		for k, batch in enumerate(self.batches(self.examples_stream(shard, num_shards), rng)):
+			if k >= skip:
+				yield self.collate_fn([self.load_example([t]) for t in batch])
+
+	def examples_stream(self, shard, num_shards):
+		for data_path in self.data_paths:
+			for t in iter_manifest(data_path, shard = shard, num_shards = num_shards):
+				if 'end' not in t:
+					t['end'] = t.get('begin', 0) + (self.duration_index[t['audio_path']] if self.duration_index is not None else audio.compute_duration(t['audio_path']))
+				duration = transcripts.compute_duration(t)
+				if (self.min_duration is None or self.min_duration <= duration) and (self.max_duration is None or duration <= self.max_duration):
+					yield t
+
+	def batches(self, examples, rng):
+		# a random example leaves the shuffle buffer whenever it is full and goes to its bucket ([examples, max duration]),
+		# a bucket is emitted as soon as it makes a batch
+		shuffle_buffer, buckets = [], {}
+
+		def add(t):
+			duration = transcripts.compute_duration(t)
+			b = buckets.setdefault(int(self.bucket(np.float64(duration))), [[], 0.0])
+			if self.batch_duration is not None and b[0] and (len(b[0]) + 1) * max(b[1], duration) > self.batch_duration:
+				yield b[0]
+				b[:] = [[], 0.0]
+			b[0].append(t)
+			b[1] = max(b[1], duration)
+			if self.batch_duration is None and len(b[0]) >= self.batch_size:
+				yield b[0]
+				b[:] = [[], 0.0]
+
+		for t in examples:
+			shuffle_buffer.append(t)
+			if len(shuffle_buffer) >= self.shuffle_buffer_size:
+				k = rng.randrange(len(shuffle_buffer))
+				shuffle_buffer[k], shuffle_buffer[-1] = shuffle_buffer[-1], shuffle_buffer[k]
+				yield from add(shuffle_buffer.pop())
+		rng.shuffle(shuffle_buffer)
+		for t in shuffle_buffer:
+			yield from add(t)
+		yield from (b[0] for b in buckets.values() if b[0])
+
+
+def iter_manifest(transcript_path, shard = 0, num_shards = 1, chunk_size = 2**20):
+	# every num_shards-th item of a json array or json lines manifest (optionally gzipped), parsed incrementally with constant memory
+	decoder = json.JSONDecoder()
+	with (gzip.open(transcript_path, 'rt') if transcript_path.endswith('.gz') else open(transcript_path)) as f:
+		buf = f.read(chunk_size)
+		if not buf.lstrip().startswith('['):
+			f.seek(0)
+			# json lines of other shards are skipped without parsing
+			yield from (json.loads(line) for k, line in enumerate(line for line in f if line.strip()) if k % num_shards == shard)
+			return
+
+		k, pos, eof = 0, buf.index('[') + 1, False
+		while True:
+			while pos < len(buf) and buf[pos] in ' \t\r\n,':
+				pos += 1
+			if pos < len(buf) and buf[pos] == ']':
+				return
+			try:
+				t, end = decoder.raw_decode(buf, pos)
+				if end == len(buf) and not eof:
+					raise json.JSONDecodeError('item may continue in the next chunk', buf, end)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+				chunk = f.read(chunk_size)
+				buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+				continue
+			if k % num_shards == shard:
+				yield t
+			k, pos = k + 1, end
+
+
+class DevicePrefetcher:
+	# wraps a DataLoader: a background thread fetches the next num_batches batches and copies their tensors to the device
+	# on a side CUDA stream, so that unpickling/collating/pinning and host-to-device copies overlap with compute.
+	# On CPU only the fetching is overlapped, num_batches = 0 fetches and copies synchronously
+	def __init__(self, data_loader, device, num_batches = 2):
+		self.data_loader = data_loader
+		self.device = torch.device(device)
+		self.num_batches = num_batches
+
+	def __len__(self):
+		return len(self.data_loader)
+
+	def to_device(self, batch, non_blocking = True):
+		return batch.to(self.device, non_blocking = non_blocking) if torch.is_tensor(batch) else type(batch)(t.to(self.device, non_blocking = non_blocking) if torch.is_tensor(t) else t for t in batch)
+
+	def __iter__(self):
+		if self.num_batches <= 0:
+			# blocking copies, pinned collate buffers (CollateBuffers) may be refilled as soon as the next batch is collated
+			yield from (self.to_device(batch, non_blocking = False) for batch in self.data_loader)
+			return
+
+		cuda = self.device.type == 'cuda'
+		device_idx = self.device.index if self.device.index is not None else torch.cuda.current_device() if cuda else None
+		queue, stop = Queue.Queue(maxsize = self.num_batches), threading.Event()
+
+		def prefetch():
+			try:
+				if cuda:
+					torch.cuda.set_device(device_idx)
+					stream = torch.cuda.Stream()
+				for batch in self.data_loader:
+					if cuda:
+						with torch.cuda.stream(stream):
+							batch = self.to_device(batch)
+							event = torch.cuda.Event()
+							event.record(stream)
+						# the host batch may live in a pinned ring buffer of CollateBuffers that is refilled a few batches later,
+						# so its async copy must have run before the next batch is collated; compute on the default stream still overlaps
+						event.synchronize()
+					else:
+						batch, event = self.to_device(batch), None
+					while not stop.is_set():
+						try:
+							queue.put((batch, event), timeout = 0.1)
+							break
+						except Queue.Full:
+							pass
+					if stop.is_set():
+						return
+				queue.put((None, None))
+			except Exception as exception:
+				queue.put((exception, None))
+
+		thread = threading.Thread(target = prefetch, daemon = True)
+		thread.start()
+		try:
+			while True:
+				batch, event = queue.get()
+				if batch is None:
+					break
+				if isinstance(batch, Exception):
+					raise batch
+				if event is not None:
+					torch.cuda.current_stream().wait_event(event)
+					for t in ([batch] if torch.is_tensor(batch) else batch):
+						if torch.is_tensor(t):
+							t.record_stream(torch.cuda.current_stream())
+				yield batch
+		finally:
+			# also reached when the consumer stops early (e.g. --iterations), the thread then drops its batch and exits
+			stop.set()
+
+
+class CollateBuffers:
+	# batch tensors for collate_fn. In DataLoader workers they are allocated in shared memory, so the batch is not copied again
+	# when sent to the main process. In the main process with pin_memory (batches go to a cuda device) a ring of flat pinned buffers
+	# per tensor is reused (sized by the largest batch seen), so neither allocation nor the pin_memory copy happen per batch; a buffer
+	# is overwritten num_buffers batches later, which is safe because DevicePrefetcher waits for a batch's copy to the device before
+	# the next batch is collated. Without pinning (cpu device) batches are kept by callers as is, so they are freshly allocated
+	def __init__(self, num_buffers = 4, pin_memory = False):
+		self.num_buffers = num_buffers
+		self.pin_memory = pin_memory
+		self.buffers = {}
+		self.counter = {}
+
+	def empty(self, name, shape, dtype):
+		numel = functools.reduce(lambda a, b: a * b, shape, 1)
+		if torch.utils.data.get_worker_info() is not None:
+			return torch.empty(shape, dtype = dtype).share_memory_()
+
+		if not self.pin_memory:
+			return torch.empty(shape, dtype = dtype)
+
+		key = (name, dtype)
+		k = self.counter[key] = (self.counter.get(key, -1) + 1) % self.num_buffers
+		ring = self.buffers.setdefault(key, [None] * self.num_buffers)
+		if ring[k] is None or ring[k].numel() < numel:
+			ring[k] = torch.empty(numel, dtype = dtype, pin_memory = self.pin_memory)
+		return ring[k][:numel].view(shape)
+
+
 class BucketingBatchSampler(torch.utils.data.Sampler):
-	def __init__(self, dataset, bucket, batch_size = 1, mixing = None):
-		super().__init__(dataset)
+	def __init__(self, dataset, bucket, batch_size = 1, mixing = None, batch_duration = None):
+		# Sampler.__init__ is a no-op whose signature differs across torch versions, so it is not called
+		# bucket maps the array of example durations to an array of integer bucket keys. Sampler state is kept in index arrays:
+		# examples are grouped by bucket once, batch boundaries never cross buckets, so they do not depend on the epoch
+		# and shuffling is a permutation within every bucket plus a permutation of batches
 
 		self.dataset = dataset
 		self.batch_size = batch_size
+		# with batch_duration, a bucket is split into batches of up to this many seconds of padded audio (len(batch) * longest example in the bucket)
+		self.batch_duration = batch_duration
 		#self.mixing = mixing or ([1 / len(self.dataset.examples)] * len(self.dataset.examples))
-		key = lambda example_idx: bucket(self.dataset.examples[example_idx])
-		self.buckets = {
-			k: list(g)
-			for k, g in itertools.groupby(sorted(range(len(self.dataset)), key = key), key = key)
-		}
+		duration = np.asarray(dataset.examples.duration, dtype = np.float64)
+		bucket = np.asarray(bucket(duration), dtype = np.int64)
+		# stable argsort is a radix sort for 16-bit keys, bucket keys are small
+		key = bucket - bucket.min() if len(bucket) > 0 else bucket
+		self.grouped = np.argsort(key.astype(np.uint16) if len(key) > 0 and key.max() < 2**16 else key, kind = 'stable').astype(np.int32 if len(bucket) < 2**31 else np.int64)
+		bucket = bucket[self.grouped]
+		self.bucket_begin = np.flatnonzero(np.diff(bucket, prepend = bucket[:1] - 1)) if len(bucket) > 0 else np.zeros(0, dtype = np.int64)
+		self.bucket_end = np.append(self.bucket_begin[1:], len(bucket))
+		bucket_size = self.bucket_end - self.bucket_begin
+		if self.batch_duration is None:
+			batch_size = np.full(len(bucket_size), self.batch_size, dtype = np.int64)
+		else:
+			bucket_max_duration = np.maximum.reduceat(duration[self.grouped], self.bucket_begin) if len(bucket_size) > 0 else np.zeros(0)
+			batch_size = np.maximum(1, np.floor(self.batch_duration / np.maximum(bucket_max_duration, 1e-6))).astype(np.int64)
+		rank_in_bucket = np.arange(len(bucket)) - np.repeat(self.bucket_begin, bucket_size)
+		self.batch_begin = np.flatnonzero(rank_in_bucket % np.repeat(batch_size, bucket_size) == 0)
+		self.batch_end = np.append(self.batch_begin[1:], len(bucket))
 		self.batch_idx = 0
 		self.shuffle(epoch = 0)
 
 	def __iter__(self):
-		return iter(self.shuffled[self.batch_idx:])
+		for k in self.batch_perm[self.batch_idx:].tolist():
+			yield self.order[self.batch_begin[k]:self.batch_end[k]].tolist()
 
 	def __len__(self):
-		return len(self.shuffled)
+		return len(self.batch_perm)
 
 	def shuffle(self, epoch):
 		rng = torch.Generator()
 		rng.manual_seed(epoch)
-		shuffle = lambda e: [e[k] for k in torch.randperm(len(e), generator = rng).tolist()]
-		num_batches = int(math.ceil(len(self.dataset) / self.batch_size))
-		batch_sequentially = lambda e: [
-			e[i * self.batch_size:(1 + i) * self.batch_size] for i in range(int(math.ceil(len(e) / self.batch_size)))
-		]
-		batches = sum([batch_sequentially(shuffle(g)) for g in self.buckets.values()], [])
-		#batches = batch_sequentially(list(range(len(self.dataset))))
-		#mixing = [int(m * self.batch_size) for m in self.mixing]
-		#inds = [chunk(i, num_batches) for k, subset in enumerate(self.dataset.examples) for i in [sum(map(len, self.dataset.examples[:k])) + torch.arange(len(subset))]]
-		#batches = [torch.cat([i[torch.randperm(len(i), generator = generator)[:m]] for i, m in zip(t, mixing)]).tolist() for t in zip(*inds)]
-		self.shuffled = [batches[k] for k in torch.randperm(len(batches), generator = rng).tolist()]
+		self.order = np.empty_like(self.grouped)
+		for begin, end in zip(self.bucket_begin.tolist(), self.bucket_end.tolist()):
+			self.order[begin:end] = self.grouped[begin:end][torch.randperm(end - begin, generator = rng).numpy()]
+		self.batch_perm = torch.randperm(len(self.batch_begin), generator = rng).numpy()
 
 	def state_dict(self):
 		return dict(batch_idx = self.batch_idx)
@@ -217,6 +746,38 @@ class BucketingBatchSampler(torch.utils.data.Sampler):
 		self.batch_idx = state_dict['batch_idx']
 
 
+class DistributedBucketingBatchSampler(BucketingBatchSampler):
+	def __init__(self, dataset, bucket, world_size, rank, sharded = False, **kwargs):
+		# every rank builds the same shuffle from the same epoch seed and takes every world_size-th batch, the tail is dropped so that
+		# all ranks run the same number of iterations. With sharded = True the dataset already holds only this rank's examples
+		# (AudioTextDataset(shard = (rank, world_size))), batches are local and truncated to the smallest rank's batch count
+		self.world_size = world_size
+		self.rank = rank
+		self.sharded = sharded
+		super().__init__(dataset, bucket, **kwargs)
+
+	def shuffle(self, epoch):
+		super().shuffle(epoch)
+		if not hasattr(self, 'num_batches'):
+			# batch boundaries do not depend on the epoch, so neither does the per-rank batch count
+			self.num_batches = len(self.batch_perm) // self.world_size if not self.sharded else self.min_over_ranks(len(self.batch_perm))
+		self.batch_perm = self.batch_perm[:self.num_batches] if self.sharded else self.batch_perm[:self.num_batches * self.world_size][self.rank::self.world_size]
+
+	def min_over_ranks(self, n):
+		if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+			return n
+		n = torch.tensor(n, device = 'cuda' if torch.distributed.get_backend() == 'nccl' else 'cpu')
+		torch.distributed.all_reduce(n, op = torch.distributed.ReduceOp.MIN)
+		return int(n)
+
+	def state_dict(self):
+		return dict(batch_idx = self.batch_idx, world_size = self.world_size)
+
+	def load_state_dict(self, state_dict):
+		# resuming with another world_size continues after the same number of consumed batches
+		self.batch_idx = state_dict['batch_idx'] * state_dict.get('world_size', 1) // self.world_size
+
+
 class Labels:
 	repeat = '2'
 	space = ' '
@@ -233,6 +794,7 @@ class Labels:
 		self.lang = lang
 		self.name = name
 		self.bpe = None
+		self.bpe_path = bpe
 		if bpe:
 			self.bpe = sentencepiece.SentencePieceProcessor()
 			self.bpe.Load(bpe)
@@ -245,6 +807,11 @@ class Labels:
 		self.word_end_idx = self.alphabet.index(self.word_end) if self.word_end in self.alphabet else -1
 		self.candidate_sep = candidate_sep
 		self.chr2idx = {l: i for i, l in enumerate(str(self))}
+		# codepoint -> label index lookup table for vectorized encode, the last entry catches codepoints outside the alphabet
+		self.symbols = [self[i] for i in range(len(self))]
+		self.codepoint2idx = np.full(2 + max(map(ord, str(self))), -1, dtype = np.int64)
+		for c, i in self.chr2idx.items():
+			self.codepoint2idx[ord(c)] = i
 		self.normalize_text_config = normalize_text_config
 
 	def split_candidates(self, text):
@@ -275,7 +842,22 @@ class Labels:
 	def encode(self, text, normalize = True):
 		normalized = self.normalize_text(text) if normalize else text
 		chars = self.split_candidates(normalized)[0]
-		return normalized, torch.LongTensor([self.chr2idx[c] if i == 0 or c != chars[i - 1] else self.repeat_idx for i, c in enumerate(chars)] if self.bpe is None else self.bpe.EncodeAsIds(chars))
+		if self.bpe is not None:
+			return normalized, torch.LongTensor(self.bpe.EncodeAsIds(chars))
+		codepoints = np.frombuffer(chars.encode('utf-32-le'), dtype = np.uint32)
+		idx = self.codepoint2idx[np.minimum(codepoints, len(self.codepoint2idx) - 1)]
+		if (idx < 0).any():
+			raise KeyError(chars[int(np.argmax(idx < 0))])
+		idx[1:][codepoints[1:] == codepoints[:-1]] = self.repeat_idx
+		return normalized, torch.from_numpy(idx)
+
+	@functools.lru_cache()
+	def digest(self):
+		# identifies the output of encode: alphabet, language module source, bpe model and text normalization config
+		digest = hashlib.sha1(repr((str(self), self.lang.__name__, self.candidate_sep, sorted(self.normalize_text_config.items()))).encode('utf-8'))
+		digest.update(open(self.lang.__file__, 'rb').read())
+		digest.update(open(self.bpe_path, 'rb').read() if self.bpe_path else b'')
+		return digest.hexdigest()
 
 	def decode(
 		self,
@@ -291,47 +873,107 @@ class Labels:
 		replace_repeat = True,
 		key = 'hyp'
 	):
-		decode_ = lambda i, j: self.postprocess_transcript(''.join(self[idx[k]] for k in range(i, j + 1) if replace_repeat is False or k == 0 or idx[k] != idx[k - 1]), replace_blank = replace_blank, replace_space = replace_space, replace_repeat = replace_repeat)
-		speaker_ = lambda i, j: (int(speaker[i:1 + j].max()) if torch.is_tensor(speaker) else speaker) if speaker is not None and speakers is None else speakers[int(speaker[i:1 + j].max())] if speaker is not None and speakers is not None else None
-		channel_ = lambda i_, j_: channel if isinstance(channel, int) else int(channel[i_])
+		return self.decode_batch(
+			[idx],
+			ts = [ts] if ts is not None else None,
+			I = [I] if I is not None else None,
+			speaker = [speaker],
+			channel = [channel],
+			speakers = speakers,
+			replace_blank = replace_blank,
+			replace_blank_series = replace_blank_series,
+			replace_space = replace_space,
+			replace_repeat = replace_repeat,
+			key = key
+		)[0]
+
+	def decode_batch(
+		self,
+		idx,
+		idxlen = None,
+		ts = None,
+		I = None,
+		speaker = None,
+		channel = 0,
+		speakers = None,
+		replace_blank = True,
+		replace_blank_series = False,
+		replace_space = False,
+		replace_repeat = True,
+		key = 'hyp'
+	):
+		# idx is a padded B x T tensor with idxlen or a list of sequences. Repeat collapse, blank series and word spans are found with
+		# tensor ops over the whole batch flattened row by row (with a trailing space column), python only joins the final strings
+		idx = [torch.as_tensor(i, dtype = torch.int64) for i in idx] if idxlen is None else torch.as_tensor(idx, dtype = torch.int64)
+		idxlen = torch.as_tensor([len(i) for i in idx] if isinstance(idx, list) else idxlen, dtype = torch.int64).reshape(-1)
+		B, T = len(idxlen), int(idxlen.max()) if len(idxlen) > 0 else 0
+		valid = torch.arange(T + 1)[None, :] < idxlen[:, None]
+		x = torch.full((B, T + 1), self.space_idx, dtype = torch.int64)
+		x[valid] = torch.cat(idx + [x[0, :0]]) if isinstance(idx, list) else idx[:, :T][valid[:, :T]]
+		x, valid = x.flatten(), valid.flatten()
+		speaker = speaker if speaker is not None else [None] * B
+		channel = channel if isinstance(channel, list) else [channel] * B
 
-		idx = torch.as_tensor(idx).tolist()
 		if ts is None:
-			return decode_(0, len(idx) - 1)
-
-		if replace_blank_series:
-			blanks = ''.join(self.blank if i == self.blank_idx else '_' for i in idx)
-			blanks = blanks.replace(self.blank * replace_blank_series, self.space * replace_blank_series)
-			for i, c in enumerate(blanks):
-				if c == self.space:
-					idx[i] = self.space_idx
-
-		silence = [self.space_idx] if replace_blank is False else [self.space_idx, self.blank_idx]
-
-		transcript, i = [], None
-		for j, k in enumerate(idx + [self.space_idx]):
-			if k == self.space_idx and i is not None:
-				while j == len(idx) or (j > 0 and idx[j] in silence):
-					j -= 1
-
-				i_, j_ = int(i if I is None else I[i]), int(j if I is None else I[j])
-				transcript.append(
-					dict(
-						begin = float(ts[i_]),
-						end = float(ts[j_]),
-						i = i_,
-						j = j_,
-						channel = channel_(i_, j_),
-						speaker = speaker_(i, j),
-						**{key: decode_(i, j)}
-					)
-				)
-
-				i = None
-			elif k not in silence and i is None:
-				i = j
+			keep = valid.clone()
+			if replace_repeat is not False:
+				keep[1:] &= (x[1:] != x[:-1]) | (torch.arange(1, len(x)) % (T + 1) == 0)
+			return self.join_spans(x, keep, torch.arange(B) * (T + 1), torch.arange(B) * (T + 1) + idxlen - 1, replace_blank, replace_space, replace_repeat)
+
+		if replace_blank_series and bool((x == self.blank_idx).any()):
+			# str.replace of blank * n by space * n: every run of L blanks gets its first L // n * n symbols turned into spaces
+			blank = x == self.blank_idx
+			run_begin = blank & ~torch.cat([torch.zeros(1, dtype = torch.bool), blank[:-1]])
+			run = torch.cumsum(run_begin, 0) - 1
+			run_len = torch.bincount(run[blank], minlength = int(run_begin.sum()))
+			pos_in_run = torch.arange(len(x)) - torch.nonzero(run_begin).flatten()[run.clamp(min = 0)]
+			x = torch.where(blank & (pos_in_run < (run_len[run.clamp(min = 0)] // replace_blank_series) * replace_blank_series), torch.tensor(self.space_idx), x)
+
+		# words are maximal runs between spaces that hold a non-silence symbol, trimmed to the first and last non-silence symbols
+		silence = (x == self.space_idx) | ((x == self.blank_idx) if replace_blank is not False else torch.zeros_like(valid))
+		word = torch.cumsum(x == self.space_idx, 0)
+		pos = torch.nonzero(~silence).flatten()
+		w = word[pos]
+		first = torch.cat([torch.ones(min(1, len(w)), dtype = torch.bool), w[1:] != w[:-1]])
+		last = torch.cat([w[1:] != w[:-1], torch.ones(min(1, len(w)), dtype = torch.bool)])
+		begin, end = pos[first], pos[last]
+		row, i, j = begin // (T + 1), begin % (T + 1), end % (T + 1)
+
+		keep = valid.clone()
+		if replace_repeat is not False:
+			keep[1:] &= (x[1:] != x[:-1]) | (torch.arange(1, len(x)) % (T + 1) == 0)
+		text = self.join_spans(x, keep, begin, end, replace_blank, replace_space, replace_repeat)
+
+		if I is not None:
+			I = [torch.as_tensor(I_).reshape(-1) for I_ in I]
+			i_ = [int(I[b][i]) for b, i in zip(row.tolist(), i.tolist())]
+			j_ = [int(I[b][j]) for b, j in zip(row.tolist(), j.tolist())]
+		else:
+			i_, j_ = i.tolist(), j.tolist()
+		ts = [torch.as_tensor(ts_).reshape(-1).tolist() for ts_ in ts]
+		speaker_ = lambda b, i, j: (int(speaker[b][i:1 + j].max()) if torch.is_tensor(speaker[b]) else speaker[b]) if speaker[b] is not None and speakers is None else speakers[int(speaker[b][i:1 + j].max())] if speaker[b] is not None and speakers is not None else None
+		channel_ = lambda b, i_: channel[b] if isinstance(channel[b], int) else int(channel[b][i_])
+
+		transcript = [[] for b in range(B)]
+		for b, i, j, i_, j_, text in zip(row.tolist(), i.tolist(), j.tolist(), i_, j_, text):
+			transcript[b].append(dict(begin = float(ts[b][i_]), end = float(ts[b][j_]), i = i_, j = j_, channel = channel_(b, i_), speaker = speaker_(b, i, j), **{key: text}))
 		return transcript
 
+	def join_spans(self, x, keep, begin, end, replace_blank, replace_space, replace_repeat):
+		# text of every [begin, end] span of x (positions marked by keep), spans do not overlap
+		mark = torch.zeros(len(x) + 1, dtype = torch.int64)
+		mark.index_add_(0, begin, torch.ones_like(begin))
+		mark.index_add_(0, end + 1, -torch.ones_like(end))
+		inside = torch.cumsum(mark, 0)[:-1] > 0
+		span = torch.cumsum(torch.zeros(len(x), dtype = torch.int64).index_fill_(0, begin, 1), 0) - 1
+		keep = keep & inside
+		offsets = [0] + torch.cumsum(torch.bincount(span[keep], minlength = len(begin)), 0).tolist()
+		chars = [self.symbols[k] for k in x[keep].tolist()]
+		return [
+			self.postprocess_transcript(''.join(chars[a:b]), replace_blank = replace_blank, replace_space = replace_space, replace_repeat = replace_repeat)
+			for a, b in zip(offsets[:-1], offsets[1:])
+		]
+
 	def postprocess_transcript(
 		self,
 		text,
@@ -351,7 +993,7 @@ class Labels:
 			text = text.replace(self.unk, '' if replace_unk is True else replace_unk)
 		if replace_space is not False:
 			text = text.replace(self.space, replace_space)
-		if replace_repeat is True:
+		if replace_repeat is True and self.repeat in text:
 			text = ''.join(c if i == 0 or c != self.repeat else text[i - 1] for i, c in enumerate(text))
 		if collapse_repeat:
 			text = ''.join(c if i == 0 or c != text[i - 1] else '' for i, c in enumerate(text))
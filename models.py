@@ -44,6 +44,30 @@ class Decoder(nn.Sequential):
 			y2 = self[1](x)
 			return y1, y2
 
+	def forward_streaming(self, x, state, final = False):
+		y1 = conv1x1_streaming(self[0], x)
+		if self.type is None:
+			return (y1, )
+		elif self.type == 'bpe':
+			y2 = x
+			for i, subblock in enumerate(self[1]):
+				y2 = subblock.forward_streaming(y2, state.setdefault(i, {}), final = final)
+			return y1, y2
+
+
+def conv1d_streaming(conv, x, buffer, final = False):
+	# a same-padded conv over consecutive chunks: buffer holds the left context (initially the left zero padding) and the right zero padding
+	# is appended only at the end of the stream, so concatenated outputs equal the offline output, and the buffer never exceeds the kernel span
+	x = torch.cat([buffer, x] + ([x.new_zeros(x.shape[:-1] + (conv.padding[0], ))] if final else []), dim = -1)
+	span = conv.dilation[0] * (conv.kernel_size[0] - 1) + 1
+	num_outputs = max(0, (x.shape[-1] - span) // conv.stride[0] + 1)
+	y = F.conv1d(x, conv.weight, conv.bias, stride = conv.stride, dilation = conv.dilation, groups = conv.groups) if num_outputs > 0 else x.new_zeros(x.shape[0], conv.out_channels, 0)
+	return y, x[..., num_outputs * conv.stride[0]:]
+
+
+def conv1x1_streaming(conv, x):
+	return conv(x) if x.shape[-1] > 0 else x.new_zeros(x.shape[0], conv.out_channels, 0)
+
 
 class ConvSamePadding(nn.Sequential):
 	def __init__(self, in_channels, out_channels, kernel_size, stride, dilation, bias, groups, separable):
@@ -139,6 +163,30 @@ class ConvBn1d(nn.Module):
 			) else x
 		return x
 
+	def forward_streaming(self, x, state, residual: List = [], final = False):
+		# state keeps the left context of every repeat and the residual frames that arrived ahead of this block's own (delayed) output
+		if not state:
+			state['buffers'] = [x.new_zeros(x.shape[0], conv[0].in_channels, conv[0].padding[0]) for conv in self.conv]
+			state['residual'] = [r[..., :0] for r in residual]
+		state['residual'] = [torch.cat([p, r], dim = -1) for p, r in zip(state['residual'], residual)]
+
+		for i, (conv, bn) in enumerate(zip(self.conv, self.bn)):
+			x, state['buffers'][i] = conv1d_streaming(conv[0], x, state['buffers'][i], final = final)
+			if x.shape[-1] == 0:
+				# nothing ready yet, later repeats still get called to append their right padding at the end of the stream
+				continue
+			for module in list(conv)[1:]:
+				x = module(x)
+
+			if i == len(self.conv) - 1:
+				residual_inputs = [bn(conv(r[..., :x.shape[-1]])) for conv, bn, r in zip(self.conv_residual, self.bn_residual, state['residual'])]
+				state['residual'] = [r[..., x.shape[-1]:] for r in state['residual']]
+			else:
+				residual_inputs = []
+
+			x = self.activation(bn(x), residual = residual_inputs)
+		return x
+
 	def fuse_conv_bn_eval(self):
 		for i in range(len(self.conv_residual)):
 			conv, bn = self.conv_residual[i], self.bn_residual[i]
@@ -316,6 +364,50 @@ class JasperNet(nn.Module):
 
 		return self.dict(logits = logits, log_probs = log_probs, olen = olen, **aux)
 
+	def init_streaming_state(self, feature_stats = None, signal_max = None):
+		# feature_stats = (mean, std) freezes normalize_features, e.g. to statistics of a calibration set, otherwise statistics of the frames
+		# seen so far are used; signal_max likewise freezes the frontend signal normalization
+		return dict(
+			frontend = dict(signal_max = signal_max),
+			normalize_features = dict(stats = feature_stats),
+			backbone = [{} for subblock in self.backbone],
+			decoder = {}
+		)
+
+	def forward_streaming(self, x: shaping.BCT, state, final = False):
+		# eval-mode inference over consecutive chunks of a stream (audio with a frontend in the model, features otherwise); every conv caches
+		# its left context, so chunk cost does not depend on stream length, and an output frame is emitted as soon as its lookahead arrived.
+		# With frozen normalization the concatenated outputs (final = True for the last chunk) equal forward() on the whole stream
+		x = x if x.ndim == 2 else x.squeeze(1)
+		x = self.frontend.forward_streaming(x, state['frontend'], final = final) if self.frontend is not None else x
+		x = self.normalize_features.forward_streaming(x, state['normalize_features']) if self.normalize_features is not None else x
+
+		residual = []
+		for i, subblock in enumerate(self.backbone):
+			x = subblock.forward_streaming(x, state['backbone'][i], residual = residual, final = final)
+			if i >= len(self.backbone) - self.num_epilogue_modules - 1:
+				residual = []
+			elif self.residual == 'dense':
+				residual.append(x)
+			elif self.residual:
+				residual = [x]
+			else:
+				residual = []
+
+		logits = self.decoder.forward_streaming(x, state['decoder'], final = final)
+		log_probs = [F.log_softmax(l, dim = 1).to(torch.float32) for l in logits]
+		return self.dict(logits = logits, log_probs = log_probs)
+
+	def streaming_lookahead(self):
+		# input frames of future context an output frame of the backbone waits for in forward_streaming
+		lookahead, stride = 0, 1
+		for subblock in self.backbone:
+			for conv in subblock.conv:
+				conv = conv[0]
+				lookahead += (conv.dilation[0] * (conv.kernel_size[0] - 1) - conv.padding[0]) * stride
+				stride *= conv.stride[0]
+		return lookahead
+
 	def freeze(self, backbone = 0, decoder0 = False, frontend = False):
 		frozen_modules_list = []
 		frozen_modules_list += list(self.backbone[:backbone]) if backbone else []
@@ -442,8 +534,10 @@ class AugmentationFrontend(nn.Module):
 		self.waveform_transform = waveform_transform
 
 	def forward(self, signal, audio_path = None, dataset_name = None, waveform_transform_debug = None, **kwargs):
+		# transforms take and return (x, sample_rate), dataset_name is only passed when known since most transforms do not take it
+		kwargs = dict(dataset_name = dataset_name) if dataset_name is not None else {}
 		if self.waveform_transform is not None:
-			signal = self.waveform_transform(signal, self.frontend.sample_rate, dataset_name = dataset_name)
+			signal = self.waveform_transform(signal, self.frontend.sample_rate, **kwargs)[0]
 
 		if waveform_transform_debug is not None:
 			waveform_transform_debug(audio_path, self.frontend.sample_rate, signal)
@@ -451,7 +545,7 @@ class AugmentationFrontend(nn.Module):
 		features = self.frontend(signal)
 
 		if self.feature_transform is not None:
-			features = self.feature_transform(features, self.frontend.sample_rate, dataset_name = dataset_name)
+			features = self.feature_transform(features, self.frontend.sample_rate, **kwargs)[0]
 
 		return features
 
@@ -577,7 +671,38 @@ class LogFilterBankFrontend(nn.Module):
 		padded_signal = F.pad(
 			padded_signal, (0, pad), mode = 'constant', value = 0
 		)  # TODO: avoid this second copy by doing pad manually
+		return self.log_mel(padded_signal)
+
+	def forward_streaming(self, signal: shaping.BT, state, final = False) -> shaping.BCT:
+		# same as forward over consecutive chunks: preemphasized samples are buffered until a whole stft frame is available; the left reflect
+		# padding waits for the first nfft / 2 + 1 samples. Without a frozen state['signal_max'] the signal is normalized by the running max
+		signal = signal if signal.is_floating_point() else signal.to(torch.float32)
+		if self.normalize_signal:
+			if signal.numel() > 0:
+				chunk_max = signal.abs().max(dim = -1, keepdim = True).values
+				state['running_max'] = torch.max(state['running_max'], chunk_max) if 'running_max' in state else chunk_max
+			signal_max = state['signal_max'] if state.get('signal_max') is not None else state.get('running_max')
+			signal = signal / (signal_max + 1e-5) if signal_max is not None else signal
+		signal = signal + self.dither0 * torch.randn_like(signal) if self.dither0 > 0 else signal
+		if self.preemphasis > 0 and signal.shape[-1] > 0:
+			# the very first sample is kept as is, like in forward
+			signal, state['last'] = signal - self.preemphasis * torch.cat([state.get('last', torch.zeros_like(signal[..., :1])), signal[..., :-1]], dim = -1), signal[..., -1:]
+		signal = signal + self.dither * torch.randn_like(signal) if self.dither > 0 else signal
 
+		pad = self.freq_cutoff - 1
+		buffer = torch.cat([state['buffer'], signal], dim = -1) if 'buffer' in state else signal
+		if not state.get('started'):
+			if buffer.shape[-1] <= pad and not final:
+				state['buffer'] = buffer
+				return buffer.new_zeros(buffer.shape[0], self.mel.out_channels, 0)
+			buffer, state['started'] = F.pad(buffer.unsqueeze(1), (pad, 0), mode = 'reflect').squeeze(1), True
+		buffer = F.pad(buffer, (0, pad), mode = 'constant', value = 0) if final else buffer
+
+		num_frames = max(0, (buffer.shape[-1] - self.nfft) // self.hop_length + 1)
+		state['buffer'] = buffer[..., num_frames * self.hop_length:]
+		return self.log_mel(buffer[..., :(num_frames - 1) * self.hop_length + self.nfft]) if num_frames > 0 else buffer.new_zeros(buffer.shape[0], self.mel.out_channels, 0)
+
+	def log_mel(self, padded_signal):
 		real_squared, imag_squared = self.stft(padded_signal.unsqueeze(dim = 1)).pow(2).split(self.freq_cutoff, dim = 1) if self.stft is not None else padded_signal.stft(self.nfft, hop_length = self.hop_length, win_length = self.win_length, window = self.window, center = False).pow(2).unbind(dim = -1)
 		power_spectrum = real_squared + imag_squared
 		log_mel_features = self.mel(power_spectrum).log()
@@ -642,6 +767,22 @@ class MaskedInstanceNorm1d(nn.InstanceNorm1d):
 			std = (zero_mean_masked.pow(2).sum(dim = -1, keepdim = True) / xlen).sqrt()
 			return zero_mean_masked / (std + self.eps)
 
+	def forward_streaming(self, x, state):
+		# frozen state['stats'] = (mean, std) if given, otherwise running statistics of all frames seen so far (unbiased std as the legacy mode)
+		if state.get('stats') is not None:
+			mean, std = state['stats']
+		else:
+			x64 = x.to(torch.float64)
+			state['n'] = state.get('n', 0) + x.shape[-1]
+			state['sum'] = state.get('sum', 0) + x64.sum(dim = -1, keepdim = True)
+			state['sum2'] = state.get('sum2', 0) + x64.pow(2).sum(dim = -1, keepdim = True)
+			if state['n'] == 0:
+				return x
+			mean = state['sum'] / state['n']
+			std = ((state['sum2'] - state['n'] * mean.pow(2)).clamp(min = 0) / max(1, state['n'] - 1)).sqrt()
+			mean, std = mean.to(x.dtype), std.to(x.dtype)
+		return (x - mean) / (std + self.eps)
+
 
 def unpad(x, lens):
 	return [e[..., :l] for e, l in zip(x, lens)]
@@ -713,7 +854,7 @@ def sparse_topk_todense(saved, device = None):
 
 
 def master_module(model):
-	return model.module if isinstance(model, nn.DataParallel) else model
+	return model.module if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else model
 
 
 ########CONFIGS########
@@ -0,0 +1,10 @@
+set -e
+# per-transform latency, cpu split (decode / waveform transform / frontend / feature transform) and DataLoader throughput
+DATA_PATH=${DATA_PATH:-data/clean_val.json}
+
+python transforms.py pipeline \
+  --data-path $DATA_PATH \
+  --num-examples 256 \
+  --num-workers 0 4 16 \
+  --output-path data/augmentation_benchmark.json \
+  "$@"
@@ -0,0 +1,164 @@
+import os
+import json
+import random
+import shutil
+import tempfile
+import struct
+import functools
+import numpy as np
+import soundfile
+import audio
+
+# a shard is a single mono int16 wav (memory-mapped on read) or flac (seekable) file holding many concatenated utterances,
+# manifest entries point into it with shard_path, shard_offset and shard_length (both in samples)
+
+
+class ShardWriter:
+	def __init__(self, output_path, sample_rate, ext = '.wav', max_shard_size = 2**31, prefix = 'shard'):
+		assert ext in ['.wav', '.flac']
+		self.output_path = output_path
+		self.sample_rate = sample_rate
+		self.ext = ext
+		self.max_shard_size = max_shard_size
+		self.prefix = prefix
+		self.shard_idx = -1
+		self.shard_path = None
+		self.file = None
+		self.num_frames = 0
+
+	def write(self, signal):
+		signal = audio.f2s_numpy(signal.numpy()) if hasattr(signal, 'numpy') else signal
+		signal = signal.reshape(-1)
+		if self.file is None or (self.num_frames + len(signal)) * 2 > self.max_shard_size:
+			self.open_next()
+		shard_offset = self.num_frames
+		if self.ext == '.wav':
+			self.file.write(signal.astype('<i2').tobytes())
+		else:
+			self.file.write(signal)
+		self.num_frames += len(signal)
+		return dict(shard_path = self.shard_path, shard_offset = shard_offset, shard_length = len(signal))
+
+	def open_next(self):
+		self.close()
+		self.shard_idx += 1
+		self.shard_path = os.path.join(self.output_path, f'{self.prefix}{self.shard_idx:05d}{self.ext}')
+		self.num_frames = 0
+		if self.ext == '.wav':
+			self.file = open(self.shard_path, 'wb')
+			self.file.write(wav_header(self.sample_rate, 0))
+		else:
+			self.file = soundfile.SoundFile(self.shard_path, 'w', samplerate = self.sample_rate, channels = 1, format = 'FLAC', subtype = 'PCM_16')
+
+	def close(self):
+		if self.file is None:
+			return
+		if self.ext == '.wav':
+			# sizes are only known once the shard is complete
+			self.file.seek(0)
+			self.file.write(wav_header(self.sample_rate, self.num_frames))
+		self.file.close()
+		self.file = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def wav_header(sample_rate, num_frames, num_channels = 1, bits_per_sample = 16):
+	block_align = num_channels * bits_per_sample // 8
+	data_size = num_frames * block_align
+	return struct.pack(
+		'<4sI4s4sIHHIIHH4sI',
+		b'RIFF',
+		36 + data_size,
+		b'WAVE',
+		b'fmt ',
+		16,
+		1,
+		num_channels,
+		sample_rate,
+		sample_rate * block_align,
+		block_align,
+		bits_per_sample,
+		b'data',
+		data_size
+	)
+
+
+@functools.lru_cache(maxsize = 1024)
+def shard_mmap(shard_path):
+	# one mapping per shard and process, a read is then a slice without any open/stat/seek
+	header = audio.read_wav_header(shard_path)
+	assert header['dtype'] == 'int16' and header['num_channels'] == 1, f'Not a mono int16 shard [{shard_path}]'
+	return header['sample_rate'], np.memmap(shard_path, dtype = 'int16', mode = 'r', offset = header['data_offset'], shape = (header['num_frames'], ))
+
+
+def read(shard_path, shard_offset, shard_length):
+	if shard_path.endswith('.wav'):
+		sample_rate, signal = shard_mmap(shard_path)
+		return sample_rate, signal[shard_offset:shard_offset + shard_length]
+	sample_rate, signal = audio.decoder_pool.read(shard_path, frame_offset = shard_offset, num_frames = shard_length)
+	return sample_rate, signal[:, 0]
+
+
+def read_audio(shard_path, shard_offset, shard_length, sample_rate, duration = None, mono = True, dtype = 'float32'):
+	sample_rate_, signal = read(shard_path, shard_offset, shard_length)
+	signal = signal[:int(duration * sample_rate_)] if duration is not None else signal
+	return audio.read_audio(
+		None,
+		sample_rate,
+		mono = mono,
+		dtype = dtype,
+		raw_bytes = np.ascontiguousarray(signal),
+		raw_sample_rate = sample_rate_,
+		raw_num_channels = 1
+	)
+
+
+class CodecBank:
+	# codec-degraded copies of whole audio files (tools.py codecbank), packed into wav shards per codec with an index
+	# {codec: {audio_path: [shard_path relative to the bank dir, shard_offset, shard_length]}}, loaded lazily once per process
+	def __init__(self, bank_dir):
+		self.bank_dir = bank_dir
+		self.index = None
+
+	def read(self, codec, audio_path):
+		if self.index is None:
+			self.index = json.load(open(os.path.join(self.bank_dir, 'index.json')))
+		entry = self.index.get(codec, {}).get(audio_path)
+		return read(os.path.join(self.bank_dir, entry[0]), entry[1], entry[2]) if entry is not None else None
+
+
+class NoiseBank:
+	# noise files resampled to one sample rate and packed into int16 wav shards once, then memory-mapped read-only by all workers,
+	# so sampling a noise window is a slice of the page cache without any decoding or per-worker copies
+	def __init__(self, noise_paths, sample_rate, bank_dir):
+		self.sample_rate = sample_rate
+		self.bank_dir = bank_dir
+		if not os.path.exists(os.path.join(bank_dir, 'index.json')):
+			NoiseBank.build(noise_paths, sample_rate, bank_dir)
+		self.index = [entry for entry in json.load(open(os.path.join(bank_dir, 'index.json'))) if entry[2] > 0]
+
+	@staticmethod
+	def build(noise_paths, sample_rate, bank_dir, max_shard_size = 2**31):
+		# built in a temp dir and renamed, concurrent builders (e.g. ranks) leave exactly one complete bank
+		tmp_dir = tempfile.mkdtemp(dir = os.path.dirname(os.path.abspath(bank_dir)), prefix = os.path.basename(bank_dir) + '.tmp')
+		index = []
+		with ShardWriter(tmp_dir, sample_rate, max_shard_size = max_shard_size) as shard_writer:
+			for noise_path in noise_paths:
+				s = shard_writer.write(audio.read_audio(noise_path, sample_rate, mono = True)[0])
+				index.append([os.path.basename(s['shard_path']), s['shard_offset'], s['shard_length']])
+		json.dump(index, open(os.path.join(tmp_dir, 'index.json'), 'w'))
+		try:
+			os.rename(tmp_dir, bank_dir)
+		except OSError:
+			shutil.rmtree(tmp_dir)
+
+	def sample(self, num_samples):
+		# random window of a random noise file, tiled when the file is shorter
+		shard_name, shard_offset, shard_length = random.choice(self.index)
+		sample_rate_, noise = read(os.path.join(self.bank_dir, shard_name), shard_offset, shard_length)
+		return noise[(random.randrange(shard_length) + np.arange(num_samples)) % shard_length]
@@ -5,12 +5,15 @@ import gzip
 import argparse
 import itertools
 import subprocess
+import tempfile
 import collections
 import functools
 import torch
 import sentencepiece
 import tqdm
 import audio
+import shards
+import transforms
 import transcripts
 import datasets
 import metrics
@@ -52,7 +55,7 @@ def subset(input_path, output_path, audio_name, align_boundary_words, cer, wer,
 	print(output_path)
 
 
-def cut_audio(output_path, sample_rate, mono, dilate, strip_prefix, audio_backend, add_sub_paths, audio_transcripts):
+def cut_audio(output_path, sample_rate, mono, dilate, strip_prefix, audio_backend, add_sub_paths, shard_ext, audio_transcripts):
 	audio_path_res = []
 	prev_audio_path = ''
 	for t in audio_transcripts:
@@ -73,8 +76,9 @@ def cut_audio(output_path, sample_rate, mono, dilate, strip_prefix, audio_backen
 		sub_path = [digest[-1:], digest[:2], segment_file_name] if add_sub_paths else [segment_file_name]
 
 		segment_path = os.path.join(output_path, *sub_path)
-		os.makedirs(os.path.dirname(segment_path), exist_ok = True)
-		audio.write_audio(segment_path, segment, sample_rate, mono = True)
+		if not shard_ext:
+			os.makedirs(os.path.dirname(segment_path), exist_ok = True)
+			audio.write_audio(segment_path, segment, sample_rate, mono = True)
 
 		if strip_prefix:
 			segment_path = segment_path[len(strip_prefix):] if segment_path.startswith(strip_prefix) else segment_path
@@ -96,6 +100,9 @@ def cut_audio(output_path, sample_rate, mono, dilate, strip_prefix, audio_backen
 			words = t.pop('words', []),
 			meta = t
 		)
+		if shard_ext:
+			# shards are appended by the parent process, segment_path then only names the utterance
+			t['segment'] = audio.f2s_numpy(segment.mean(dim = 0).numpy())
 
 		prev_audio_path = audio_path
 		audio_path_res.append(t)
@@ -103,7 +110,7 @@ def cut_audio(output_path, sample_rate, mono, dilate, strip_prefix, audio_backen
 
 
 def cut(
-	input_path, output_path, sample_rate, mono, dilate, strip, strip_prefix, audio_backend, add_sub_paths, num_workers
+	input_path, output_path, sample_rate, mono, dilate, strip, strip_prefix, audio_backend, add_sub_paths, num_workers, shards_, max_shard_size_mb
 ):
 	os.makedirs(output_path, exist_ok = True)
 
@@ -117,11 +124,17 @@ def cut(
 	print("Unique audio_path count: ", len(transcript_by_path.keys()))
 	with multiprocessing.pool.Pool(processes = num_workers) as pool:
 		map_func = functools.partial(
-			cut_audio, output_path, sample_rate, mono, dilate, strip_prefix, audio_backend, add_sub_paths
+			cut_audio, output_path, sample_rate, mono, dilate, strip_prefix, audio_backend, add_sub_paths, shards_
 		)
 		transcript_cat = []
+		shard_writer = shards.ShardWriter(output_path, sample_rate, ext = shards_, max_shard_size = max_shard_size_mb * 2**20) if shards_ else None
 		for ts in tqdm.tqdm(pool.imap_unordered(map_func, transcript_by_path.values())):
+			for t in ts if shard_writer is not None else []:
+				t.update(shard_writer.write(t.pop('segment')))
+				t['shard_path'] = t['shard_path'][len(strip_prefix):] if strip_prefix and t['shard_path'].startswith(strip_prefix) else t['shard_path']
 			transcript_cat.extend(ts)
+		if shard_writer is not None:
+			shard_writer.close()
 
 	json.dump(
 		transcripts.strip(transcript_cat, strip),
@@ -133,6 +146,47 @@ def cut(
 	print(output_path)
 
 
+def transcode_codec_bank(codec, sample_rate, tmpdir, t):
+	# same sox transcode as SoxAug, shard-backed utterances are materialized into a temp wav first
+	audio_path = t['audio_path']
+	if 'shard_path' in t:
+		audio_path = tempfile.mkstemp(suffix = '.wav', dir = tmpdir)[1]
+		audio.write_audio(audio_path, shards.read_audio(t['shard_path'], t['shard_offset'], t['shard_length'], sample_rate)[0], sample_rate, mono = True)
+	try:
+		signal, _ = transforms.SoxAug(['transcode_' + codec], 1.0)(audio_path, sample_rate, normalize = False, tmpdir = tmpdir)
+		return t['audio_path'], signal.clamp(-2**15, 2**15 - 1).to(torch.int16).numpy()
+	except subprocess.CalledProcessError:
+		print('Transcoding failed', codec, t['audio_path'])
+		return t['audio_path'], None
+	finally:
+		if audio_path != t['audio_path']:
+			os.remove(audio_path)
+
+
+def codecbank(input_path, output_path, codecs, sample_rate, num_workers, max_shard_size_mb, tmpdir):
+	array = lambda o: [o] if isinstance(o, dict) else o
+	transcript = sum([array(json.load(open(transcript_path))) for transcript_path in input_path], [])
+	transcript_by_path = {t['audio_path']: t for t in transcript}
+	print('Unique audio_path count: ', len(transcript_by_path))
+
+	index_path = os.path.join(output_path, 'index.json')
+	index = json.load(open(index_path)) if os.path.exists(index_path) else {}
+	with multiprocessing.pool.Pool(processes = num_workers) as pool:
+		for codec in codecs:
+			os.makedirs(os.path.join(output_path, codec), exist_ok = True)
+			index[codec] = {}
+			map_func = functools.partial(transcode_codec_bank, codec, sample_rate, tmpdir)
+			with shards.ShardWriter(os.path.join(output_path, codec), sample_rate, max_shard_size = max_shard_size_mb * 2**20) as shard_writer:
+				for audio_path, signal in tqdm.tqdm(pool.imap_unordered(map_func, transcript_by_path.values()), total = len(transcript_by_path)):
+					if signal is not None:
+						s = shard_writer.write(signal)
+						index[codec][audio_path] = [os.path.relpath(s['shard_path'], output_path), s['shard_offset'], s['shard_length']]
+			print(codec, len(index[codec]))
+
+	json.dump(index, open(index_path, 'w'), ensure_ascii = False)
+	print(index_path)
+
+
 def cat(input_path, output_path):
 	transcript_paths = [transcript_path for transcript_path in input_path if transcript_path.endswith('.json')] + [
 		os.path.join(transcript_dir, transcript_name) for transcript_dir in input_path if os.path.isdir(transcript_dir)
@@ -146,8 +200,15 @@ def cat(input_path, output_path):
 	print(output_path)
 
 
-def du(input_path):
+def du(input_path, duration_index):
 	transcript = json.load(open(input_path))
+	if duration_index is not None:
+		# utterances without an end cover the rest of the file
+		duration_index = audio.DurationIndex(duration_index)
+		no_end = [t for t in transcript if 'end' not in t]
+		for t, duration in zip(no_end, duration_index.lookup(t['audio_path'] for t in no_end)):
+			t['end'] = duration
+		duration_index.save()
 	print(
 		input_path,
 		int(os.path.getsize(input_path) // 1e6),
@@ -160,7 +221,7 @@ def du(input_path):
 	)
 
 
-def csv2json(input_path, gz, group, reset_duration):
+def csv2json(input_path, gz, group, reset_duration, duration_index):
 	gzopen = lambda file_path, mode = 'r': gzip.open(file_path, mode + 't') if file_path.endswith('.gz') else open(file_path, mode)
 
 	def duration(audio_name):
@@ -172,15 +233,34 @@ def csv2json(input_path, gz, group, reset_duration):
 			audio_path = s[0],
 			ref = s[1],
 			begin = 0.0,
-			end = float(s[2]) if not reset_duration else duration(os.path.basename(s[0])),
+			end = float(s[2]) if not reset_duration else duration(os.path.basename(s[0])) if duration_index is None else None,
 			**(dict(group = s[0].split('/')[group]) if group >= 0 else {})
 		) for l in gzopen(input_path) if '"' not in l for s in [l.strip().split(',')]
 	]
+	if reset_duration and duration_index is not None:
+		duration_index = audio.DurationIndex(duration_index)
+		for t, duration in zip(transcript, duration_index.lookup(t['audio_path'] for t in transcript)):
+			t['end'] = duration
+		duration_index.save()
 	output_path = input_path + '.json' + ('.gz' if gz else '')
 	json.dump(transcript, gzopen(output_path, 'w'), ensure_ascii = False, indent = 2, sort_keys = True)
 	print(output_path)
 
 
+def durindex(input_path, index_path, audio_backend, num_workers):
+	audio_paths = [
+		audio_path for input_path in input_path for audio_path in (
+			[os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(input_path) for filename in filenames]
+			if os.path.isdir(input_path) else [t['audio_path'] for t in json.load(open(input_path))]
+			if input_path.endswith('.json') else [input_path]
+		)
+	]
+	duration_index = audio.DurationIndex(index_path, backend = audio_backend, num_workers = num_workers)
+	durations = duration_index.lookup(audio_paths)
+	duration_index.save()
+	print(index_path, '|', len(duration_index.index), 'files |', int(sum(dict(zip(audio_paths, durations)).values()) / (60 * 60)), 'hours')
+
+
 def diff(ours, theirs, key, output_path):
 	transcript_ours = {t['audio_file_name']: t for t in json.load(open(ours))}
 	transcript_theirs = {t['audio_file_name']: t for t in json.load(open(theirs))}
@@ -499,11 +579,23 @@ if __name__ == '__main__':
 	cmd.add_argument('--strip', nargs = '*', default = ['alignment', 'words'])
 	cmd.add_argument('--mono', action = 'store_true')
 	cmd.add_argument('--strip-prefix', type = str, default = '')
-	cmd.add_argument('--audio-backend', default = 'ffmpeg', choices = ['sox', 'ffmpeg'])
+	cmd.add_argument('--audio-backend', default = 'ffmpeg', choices = ['sox', 'ffmpeg', 'pool'])
 	cmd.add_argument('--add-sub-paths', action = 'store_true')
 	cmd.add_argument('--num-workers', type = int, default = 32)
+	cmd.add_argument('--shards', dest = 'shards_', choices = ['.wav', '.flac'], help = 'pack segments into shards instead of writing a file per segment')
+	cmd.add_argument('--max-shard-size-mb', type = int, default = 2048)
 	cmd.set_defaults(func = cut)
 
+	cmd = subparsers.add_parser('codecbank', help = 'pre-transcode audio files for AMRNB / GSM / PSSPAMRNB augmentations, pass the output dir as their codec_bank')
+	cmd.add_argument('--input-path', '-i', nargs = '+', required = True)
+	cmd.add_argument('--output-path', '-o', required = True)
+	cmd.add_argument('--codecs', nargs = '+', default = ['amr-nb', 'gsm'])
+	cmd.add_argument('--sample-rate', '-r', type = int, default = 8_000, choices = [8_000, 16_000, 32_000, 48_000])
+	cmd.add_argument('--num-workers', type = int, default = 32)
+	cmd.add_argument('--max-shard-size-mb', type = int, default = 2048)
+	cmd.add_argument('--tmpdir', default = '/dev/shm')
+	cmd.set_defaults(func = codecbank)
+
 	cmd = subparsers.add_parser('cat')
 	cmd.add_argument('--input-path', '-i', nargs = '+')
 	cmd.add_argument('--output-path', '-o')
@@ -514,8 +606,16 @@ if __name__ == '__main__':
 	cmd.add_argument('--gzip', dest = 'gz', action = 'store_true')
 	cmd.add_argument('--group', type = int, default = 0)
 	cmd.add_argument('--reset-duration', action = 'store_true')
+	cmd.add_argument('--duration-index')
 	cmd.set_defaults(func = csv2json)
 
+	cmd = subparsers.add_parser('durindex')
+	cmd.add_argument('--input-path', '-i', nargs = '+', required = True)
+	cmd.add_argument('--index-path', '-o', default = 'data/duration_index.json.gz')
+	cmd.add_argument('--audio-backend', default = 'ffmpeg', choices = ['ffmpeg', 'sox'])
+	cmd.add_argument('--num-workers', type = int, default = 16)
+	cmd.set_defaults(func = durindex)
+
 	cmd = subparsers.add_parser('diff')
 	cmd.add_argument('--ours', required = True)
 	cmd.add_argument('--theirs', required = True)
@@ -532,6 +632,7 @@ if __name__ == '__main__':
 
 	cmd = subparsers.add_parser('du')
 	cmd.add_argument('input_path')
+	cmd.add_argument('--duration-index')
 	cmd.set_defaults(func = du)
 
 	cmd = subparsers.add_parser('transcode')
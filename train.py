@@ -1,4 +1,7 @@
 import argparse
+import datetime
+import functools
+import inspect
 import json
 import math
 import os
@@ -8,6 +11,7 @@ import time
 import torch.utils.data
 import torch.utils.tensorboard
 import apex
+import audio
 import datasets
 import decoders
 import exphtml
@@ -19,11 +23,11 @@ import torch
 import transforms
 import vis
 import utils
+import numpy as np
 
 
-def apply_model(data_loader, model, labels, decoder, device, crash_on_oom):
-	for meta, x, xlen, y, ylen in data_loader:
-		x, xlen, y, ylen = x.to(device, non_blocking = True), xlen.to(device, non_blocking = True), y.to(device, non_blocking = True), ylen.to(device, non_blocking = True)
+def apply_model(data_loader, model, labels, decoder, device, crash_on_oom, prefetch_batches = 2):
+	for meta, x, xlen, y, ylen in datasets.DevicePrefetcher(data_loader, device, prefetch_batches):
 		with torch.no_grad():
 			try:
 				logits, log_probs, olen, loss = map(model(x, xlen, y = y, ylen = ylen).get, ['logits', 'log_probs', 'olen', 'loss'])
@@ -34,7 +38,7 @@ def apply_model(data_loader, model, labels, decoder, device, crash_on_oom):
 					raise
 
 		entropy_char, *entropy_bpe = list(map(models.entropy, log_probs, olen))
-		hyp = [list(map(l.decode, d.decode(lp, o))) for l, d, lp, o in zip(labels, decoder, log_probs, olen)]
+		hyp = [l.decode_batch(d.decode(lp, o)) for l, d, lp, o in zip(labels, decoder, log_probs, olen)]
 		logits = list(map(models.unpad, logits, olen))
 		y = list(map(models.unpad, y, ylen))
 		yield meta, loss.cpu(), entropy_char.cpu(), hyp, logits, y
@@ -63,7 +67,7 @@ def evaluate_model(
 		model.eval()
 		if args.adapt_bn:
 			models.reset_bn_running_stats_(model)
-			for _ in apply_model(val_data_loader, model, labels, decoder, args.device, args.val_crash_oom):
+			for _ in apply_model(val_data_loader, model, labels, decoder, args.device, args.val_crash_oom, args.prefetch_batches):
 				pass
 		model.eval()
 		cpu_list = lambda l: [[t.cpu() for t in t_] for t_ in l]
@@ -72,7 +76,8 @@ def evaluate_model(
 																						labels,
 																						decoder,
 																						args.device,
-																						args.val_crash_oom)):
+																						args.val_crash_oom,
+																						args.prefetch_batches)):
 			logits_.extend(zip(*cpu_list(logits)) if not training and args.logits else [])
 			y_.extend(cpu_list(y))
 			stats = [
@@ -242,6 +247,10 @@ def main(args):
 	print('\n', 'Experiment id:', args.experiment_id, '\n')
 	if args.dry:
 		return
+	if args.world_size > 1:
+		torch.distributed.init_process_group(args.dist_backend, init_method = args.dist_url, world_size = args.world_size, rank = args.rank, timeout = datetime.timedelta(seconds = args.dist_timeout))
+		if args.device != 'cpu':
+			torch.cuda.set_device(args.rank % torch.cuda.device_count())
 	utils.set_random_seed(args.seed)
 	if args.cudnn == 'benchmark':
 		torch.backends.cudnn.benchmark = True
@@ -333,10 +342,25 @@ def main(args):
 	vocab = set(map(str.strip, open(args.vocab))) if os.path.exists(args.vocab) else set()
 	error_analyzer = metrics.ErrorAnalyzer(metrics.WordTagger(lang, vocab = vocab, word_tags = word_tags), metrics.ErrorTagger(), val_config.get('error_analyzer', {}))
 
-	make_transform = lambda name_args, prob: None if not name_args else getattr(transforms, name_args[0])(*name_args[1:]) if prob is None else getattr(transforms, name_args[0])(prob, *name_args[1:]) if prob > 0 else None
+	def make_transform(name_args, prob, **kwargs):
+		# arguments after the transform name fill its parameters other than prob in order (e.g. AMRNB <codec_bank>). prob is passed
+		# by keyword to transforms that take it, other transforms are wrapped in RandomCompose. kwargs (e.g. sample_rate, so that
+		# MixExternalNoise builds its noise bank here, once in the main process before DataLoader workers start) are passed
+		# to transforms that accept them and do not get them from the command line
+		if not name_args or (prob is not None and prob <= 0):
+			return None
+		transform = getattr(transforms, name_args[0])
+		signature = inspect.signature(transform).parameters
+		params = [k for k in signature if k != 'prob']
+		kwargs = {k: v for k, v in kwargs.items() if k in params[len(name_args) - 1:] and v is not None}
+		kwargs.update(zip(params, name_args[1:]))
+		if prob is None:
+			return transform(**kwargs)
+		return transform(prob = prob, **kwargs) if 'prob' in signature else transforms.RandomCompose([transform(**kwargs)], prob)
+
 	val_frontend = models.AugmentationFrontend(
 		frontend,
-		waveform_transform = make_transform(args.val_waveform_transform, args.val_waveform_transform_prob),
+		waveform_transform = make_transform(args.val_waveform_transform, args.val_waveform_transform_prob, sample_rate = args.sample_rate, bank_dir = args.noise_bank_dir),
 		feature_transform = make_transform(args.val_feature_transform, args.val_feature_transform_prob)
 	)
 
@@ -349,6 +373,11 @@ def main(args):
 		)
 		os.makedirs(args.val_waveform_transform_debug_dir, exist_ok = True)
 
+	audio_cache = audio.DecodedAudioCache(
+		args.audio_cache_dir, max_size = args.audio_cache_max_size_gb * 1e9 if args.audio_cache_max_size_gb else None
+	) if args.audio_cache_dir else None
+	duration_index = audio.DurationIndex(args.duration_index) if args.duration_index else None
+
 	val_data_loaders = {
 		os.path.basename(val_data_path): torch.utils.data.DataLoader(
 			val_dataset,
@@ -368,7 +397,12 @@ def main(args):
 				frontend = val_frontend if not args.frontend_in_model else None,
 				waveform_transform_debug_dir = args.val_waveform_transform_debug_dir,
 				min_duration = args.min_duration,
-				time_padding_multiple = args.batch_time_padding_multiple
+				time_padding_multiple = args.batch_time_padding_multiple,
+				audio_backend = args.audio_backend,
+				audio_cache = audio_cache,
+				duration_index = duration_index,
+				feature_cache = datasets.FeatureCache(args.val_feature_cache_dir, val_frontend) if args.val_feature_cache_dir and not args.frontend_in_model else None,
+				device = args.device
 			)
 		]
 	}
@@ -397,40 +431,74 @@ def main(args):
 
 	model.freeze(backbone = args.freeze_backbone, decoder0 = args.freeze_decoder, frontend = args.freeze_frontend)
 
+	train_feature_transform = make_transform(args.train_feature_transform, args.train_feature_transform_prob)
 	train_frontend = models.AugmentationFrontend(
 		frontend,
-		waveform_transform = make_transform(args.train_waveform_transform, args.train_waveform_transform_prob),
-		feature_transform = make_transform(args.train_feature_transform, args.train_feature_transform_prob)
-	)
-	train_dataset = datasets.AudioTextDataset(
-		args.train_data_path,
-		labels,
-		args.sample_rate,
-		frontend = train_frontend if not args.frontend_in_model else None,
-		min_duration = args.min_duration,
-		max_duration = args.max_duration,
-		time_padding_multiple = args.batch_time_padding_multiple
+		waveform_transform = make_transform(args.train_waveform_transform, args.train_waveform_transform_prob, sample_rate = args.sample_rate, bank_dir = args.noise_bank_dir),
+		feature_transform = train_feature_transform if not args.train_feature_transform_batch else None
 	)
+	# like the per-example path, batched feature transforms need features from the dataset, not waveforms for an in-model frontend
+	batch_feature_transform = train_feature_transform if args.train_feature_transform_batch == 'collate' and not args.frontend_in_model else None
+	device_feature_transform = train_feature_transform if args.train_feature_transform_batch == 'device' and not args.frontend_in_model else None
+	bucket = lambda duration: np.ceil((duration / args.window_stride + 1) / args.batch_time_padding_multiple).astype(int)  #+1 mean bug fix with bucket sizing
 	train_dataset_name = '_'.join(map(os.path.basename, args.train_data_path))
-	sampler = datasets.BucketingBatchSampler(
-		train_dataset,
-		batch_size = args.train_batch_size,
-		mixing = args.train_data_mixing,
-		bucket = lambda example: int(
-			math.ceil(
-				((example[0]['end'] - example[0]['begin']) / args.window_stride + 1) / args.batch_time_padding_multiple
-			)
+	if args.train_streaming:
+		assert args.train_streaming_epoch_batches, '--train-streaming needs --train-streaming-epoch-batches, streaming epochs have no known length'
+		# the streaming dataset yields collated batches and is its own sampler (shuffle, batch_idx, state_dict)
+		train_dataset = sampler = datasets.StreamingAudioTextDataset(
+			args.train_data_path,
+			labels,
+			args.sample_rate,
+			bucket = bucket,
+			batch_size = args.train_batch_size,
+			batch_duration = args.train_batch_duration,
+			shuffle_buffer_size = args.train_shuffle_buffer_size,
+			rank = args.rank,
+			world_size = args.world_size,
+			frontend = train_frontend if not args.frontend_in_model else None,
+			min_duration = args.min_duration,
+			max_duration = args.max_duration,
+			time_padding_multiple = args.batch_time_padding_multiple,
+			audio_backend = args.audio_backend,
+			audio_cache = audio_cache,
+			duration_index = duration_index,
+			batch_feature_transform = batch_feature_transform,
+			device = args.device
+		)
+	else:
+		train_dataset = datasets.AudioTextDataset(
+			args.train_data_path,
+			labels,
+			args.sample_rate,
+			frontend = train_frontend if not args.frontend_in_model else None,
+			min_duration = args.min_duration,
+			max_duration = args.max_duration,
+			time_padding_multiple = args.batch_time_padding_multiple,
+			audio_backend = args.audio_backend,
+			audio_cache = audio_cache,
+			duration_index = duration_index,
+			shard = (args.rank, args.world_size) if args.world_size > 1 and args.train_data_shard_per_rank else None,
+			batch_feature_transform = batch_feature_transform,
+			device = args.device
+		)
+		sampler = (datasets.BucketingBatchSampler if args.world_size == 1 else functools.partial(datasets.DistributedBucketingBatchSampler, world_size = args.world_size, rank = args.rank, sharded = args.train_data_shard_per_rank))(
+			train_dataset,
+			batch_size = args.train_batch_size,
+			batch_duration = args.train_batch_duration,
+			mixing = args.train_data_mixing,
+			bucket = bucket
 		)
-	)  #+1 mean bug fix with bucket sizing
 	train_data_loader = torch.utils.data.DataLoader(
 		train_dataset,
 		num_workers = args.num_workers,
-		collate_fn = train_dataset.collate_fn,
+		collate_fn = train_dataset.collate_fn if not args.train_streaming else None,
 		pin_memory = True,
-		batch_sampler = sampler,
 		worker_init_fn = datasets.worker_init_fn,
-		timeout = args.timeout
+		timeout = args.timeout,
+		**(dict(batch_sampler = sampler) if not args.train_streaming else dict(batch_size = None))
 	)
+	# streaming epochs have no known length, PolynomialDecayLR then counts --train-streaming-epoch-batches per epoch
+	num_batches = len(train_data_loader) if not args.train_streaming else args.train_streaming_epoch_batches
 	optimizer = torch.optim.SGD(
 		model.parameters(),
 		lr = args.lr,
@@ -454,7 +522,7 @@ def main(args):
 										) if args.scheduler == 'MultiStepLR' else optimizers.PolynomialDecayLR(
 											optimizer,
 											power = args.decay_power,
-											decay_steps = len(train_data_loader) * args.decay_epochs,
+											decay_steps = num_batches * args.decay_epochs,
 											end_lr = args.decay_lr
 										) if args.scheduler == 'PolynomialDecayLR' else optimizers.NoopLR(optimizer)
 	epoch, iteration = 0, 0
@@ -466,14 +534,23 @@ def main(args):
 			epoch += 1
 
 	if args.device != 'cpu':
-		model, optimizer = models.data_parallel_and_autocast(model, optimizer, opt_level = args.fp16, keep_batchnorm_fp32 = args.fp16_keep_batchnorm_fp32)
+		model, optimizer = models.data_parallel_and_autocast(model, optimizer, data_parallel = args.world_size == 1, opt_level = args.fp16, keep_batchnorm_fp32 = args.fp16_keep_batchnorm_fp32)
 	if checkpoint and args.fp16 and checkpoint['amp_state_dict'] is not None:
 		apex.amp.load_state_dict(checkpoint['amp_state_dict'])
+	if args.world_size > 1:
+		model = torch.nn.parallel.DistributedDataParallel(model, device_ids = [torch.cuda.current_device()] if args.device != 'cpu' else None)
+	# with DistributedDataParallel only rank 0 evaluates and saves checkpoints, the other ranks wait for it in a barrier, so --dist-timeout
+	# must cover a whole validation pass. Evaluation runs the unwrapped module, a forward through the wrapper would broadcast buffers to ranks that are not listening
+	def evaluate_model_(args, val_data_loaders, model, *args_):
+		if args.rank == 0:
+			evaluate_model(args, val_data_loaders, models.master_module(model) if args.world_size > 1 else model, *args_)
+		if args.world_size > 1:
+			torch.distributed.barrier()
 
 	model.train()
 
 	os.makedirs(args.experiment_dir, exist_ok = True)
-	tensorboard_dir = os.path.join(args.experiment_dir, 'tensorboard')
+	tensorboard_dir = os.path.join(args.experiment_dir, 'tensorboard' if args.rank == 0 else f'tensorboard_rank{args.rank}')
 	if checkpoint and args.experiment_name:
 		tensorboard_dir_checkpoint = os.path.join(os.path.dirname(args.checkpoint[0]), 'tensorboard')
 		if os.path.exists(tensorboard_dir_checkpoint) and not os.path.exists(tensorboard_dir):
@@ -495,12 +572,13 @@ def main(args):
 	for epoch in range(epoch, args.epochs):
 		sampler.shuffle(epoch + args.seed_sampler)
 		time_epoch_start = time.time()
-		for batch_idx, (meta, x, xlen, y, ylen) in enumerate(train_data_loader, start = sampler.batch_idx):
+		for batch_idx, (meta, x, xlen, y, ylen) in enumerate(datasets.DevicePrefetcher(train_data_loader, args.device, args.prefetch_batches), start = sampler.batch_idx):
+			if device_feature_transform is not None:
+				x = device_feature_transform(x, args.sample_rate, xlen = xlen)[0]
 			toc_data = time.time()
 			lr = optimizer.param_groups[0]['lr']
 			lr_avg = metrics.exp_moving_average(lr_avg, lr, max = 1)
 
-			x, xlen, y, ylen = x.to(args.device, non_blocking = True), xlen.to(args.device, non_blocking = True), y.to(args.device, non_blocking = True), ylen.to(args.device, non_blocking = True)
 			try:
 				#TODO check nan values in tensors, they can break running_stats in bn
 				log_probs, olen, loss = map(model(x, xlen, y = y, ylen = ylen).get, ['log_probs', 'olen', 'loss'])
@@ -561,13 +639,13 @@ def main(args):
 			performance_meter.update_time_metrics(time_ms_data, time_ms_fwd, time_ms_bwd, time_ms_model)
 			time_ms_avg = metrics.exp_moving_average(time_ms_avg, time_ms_data + time_ms_model, max = 10_000)
 			print(
-				f'{args.experiment_id} | epoch: {epoch:02d} iter: [{batch_idx: >6d} / {len(train_data_loader)} {iteration: >6d}] ent: <{entropy_avg:.2f}> loss: {loss_cur:.2f} <{loss_avg:.2f}> time: ({"x".join(map(str, x.shape))}) {time_ms_data:.2f}+{time_ms_fwd:4.0f}+{time_ms_bwd:4.0f} <{time_ms_avg:.0f}> | lr: {lr:.5f}'
+				f'{args.experiment_id} | epoch: {epoch:02d} iter: [{batch_idx: >6d} / {num_batches} {iteration: >6d}] ent: <{entropy_avg:.2f}> loss: {loss_cur:.2f} <{loss_avg:.2f}> time: ({"x".join(map(str, x.shape))}) {time_ms_data:.2f}+{time_ms_fwd:4.0f}+{time_ms_bwd:4.0f} <{time_ms_avg:.0f}> | lr: {lr:.5f}'
 			)
 			iteration += 1
 			sampler.batch_idx += 1
 
 			if iteration > 0 and (iteration % args.val_iteration_interval == 0 or iteration == args.iterations):
-				evaluate_model(
+				evaluate_model_(
 					args,
 					val_data_loaders,
 					model,
@@ -589,7 +667,7 @@ def main(args):
 		sampler.batch_idx = 0
 		print('Epoch time', (time.time() - time_epoch_start) / 60, 'minutes')
 		if not args.skip_on_epoch_end_evaluation:
-			evaluate_model(
+			evaluate_model_(
 				args,
 				val_data_loaders,
 				model,
@@ -632,8 +710,19 @@ if __name__ == '__main__':
 	parser.add_argument('--val-data-path', nargs = '*', default = [])
 	parser.add_argument('--num-workers', type = int, default = 64)
 	parser.add_argument('--train-batch-size', type = int, default = 256)
+	parser.add_argument('--train-batch-duration', type = float, help = 'seconds of padded audio per train batch, overrides --train-batch-size')
+	parser.add_argument('--train-streaming', action = 'store_true', help = 'read train manifests lazily with bounded-buffer shuffling and length bucketing, for manifests that do not fit in memory')
+	parser.add_argument('--train-shuffle-buffer-size', type = int, default = 2**16, help = 'examples kept per DataLoader worker for shuffling with --train-streaming')
+	parser.add_argument('--train-streaming-epoch-batches', type = int, help = 'estimated number of batches per epoch with --train-streaming, for logging and PolynomialDecayLR')
 	parser.add_argument('--val-batch-size', type = int, default = 256)
 	parser.add_argument('--device', default = 'cuda', choices = ['cuda', 'cpu'])
+	parser.add_argument('--prefetch-batches', type = int, default = 2, help = 'batches fetched and copied to the device ahead of compute by a background thread, 0 disables')
+	parser.add_argument('--world-size', type = int, default = 1, help = 'number of DistributedDataParallel processes, one per GPU (or CPU process with gloo)')
+	parser.add_argument('--rank', type = int, default = 0)
+	parser.add_argument('--dist-backend', default = 'nccl', choices = ['nccl', 'gloo'])
+	parser.add_argument('--dist-url', default = 'tcp://127.0.0.1:23456')
+	parser.add_argument('--dist-timeout', type = int, default = 4 * 3600, help = 'seconds before a collective op fails, ranks wait for rank 0 to finish validation')
+	parser.add_argument('--train-data-shard-per-rank', action = 'store_true', help = 'every rank parses and keeps only its own ~1/world_size of the train manifest, split by audio_path')
 	parser.add_argument(
 		'--checkpoint',
 		nargs = '*',
@@ -704,10 +793,17 @@ if __name__ == '__main__':
 		help = 'feature aug transforms are applied after frontend'
 	)
 	parser.add_argument('--val-feature-transform-prob', type = float, default = None)
+	parser.add_argument('--val-feature-cache-dir', help = 'cache float16 frontend features of validation sets without waveform/feature transforms in this dir')
 	parser.add_argument('--train-waveform-transform', nargs = '*', default = [])
 	parser.add_argument('--train-waveform-transform-prob', type = float, default = None)
 	parser.add_argument('--train-feature-transform', nargs = '*', default = [])
 	parser.add_argument('--train-feature-transform-prob', type = float, default = None)
+	parser.add_argument('--noise-bank-dir', help = 'noise bank dir of MixExternalNoise, by default next to the noise list')
+	parser.add_argument(
+		'--train-feature-transform-batch',
+		choices = ['collate', 'device'],
+		help = 'apply --train-feature-transform to whole padded batches in the collate step or on the training device instead of per example in DataLoader workers'
+	)
 	parser.add_argument(
 		'--train-batch-accumulate-iterations', type = int, default = 1, help = 'number of gradient accumulation steps'
 	)
@@ -784,4 +880,12 @@ if __name__ == '__main__':
 	parser.add_argument('--train-crash-oom', action = 'store_true')
 	parser.add_argument('--val-crash-oom', action = 'store_true')
 	parser.add_argument('--val-config', default = 'configs/ru_val_config.json')
+	parser.add_argument(
+		'--audio-backend',
+		choices = ['mmap', 'scipy', 'soundfile', 'sox', 'ffmpeg', 'pool'],
+		help = 'pool keeps in-process libsndfile decoders open instead of spawning ffmpeg per file'
+	)
+	parser.add_argument('--audio-cache-dir', help = 'cache decoded and resampled audio as int16 wav in this dir')
+	parser.add_argument('--audio-cache-max-size-gb', type = float, help = 'evict least recently used cached audio above this size')
+	parser.add_argument('--duration-index', help = 'persistent audio duration index for utterances without an end, see tools.py durindex')
 	main(parser.parse_args())
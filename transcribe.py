@@ -122,21 +122,19 @@ def main(args):
 					channel = channel[i],
 					begin = meta[i]['begin'],
 					end = meta[i]['end'],
-					ref = labels.decode(y[i, 0, :ylen[i]].tolist())
+					ref = ref
 				)
-			] for i in range(len(decoded))]
-			hyp_segments = [
-				labels.decode(
-					decoded[i],
-					ts[i],
-					channel = channel[i],
-					replace_blank = True,
-					replace_blank_series = args.replace_blank_series,
-					replace_repeat = True,
-					replace_space = False,
-					speaker = speaker[i] if isinstance(speaker[i], str) else None
-				) for i in range(len(decoded))
-			]
+			] for i, ref in enumerate(labels.decode_batch(y[:len(decoded), 0].cpu(), ylen[:len(decoded), 0].cpu()))]
+			hyp_segments = labels.decode_batch(
+				decoded,
+				ts = ts,
+				channel = channel,
+				replace_blank = True,
+				replace_blank_series = args.replace_blank_series,
+				replace_repeat = True,
+				replace_space = False,
+				speaker = [s if isinstance(s, str) else None for s in speaker]
+			)
 
 			ref, hyp = '\n'.join(transcripts.join(ref = r) for r in ref_segments).strip(), '\n'.join(transcripts.join(hyp = h) for h in hyp_segments).strip()
 			if args.verbose:
@@ -164,17 +162,16 @@ def main(args):
 					blank = labels.blank_idx,
 					pack_backpointers = args.pack_backpointers
 				)
-				ref_segments = [
-					labels.decode(
-						y[i, 0, :ylen[i]].tolist(),
-						ts[i],
-						alignment[i],
-						channel = channel[i],
-						speaker = speaker[i],
-						key = 'ref',
-						speakers = speakers
-					) for i in range(len(decoded))
-				]
+				ref_segments = labels.decode_batch(
+					y[:len(decoded), 0].cpu(),
+					ylen[:len(decoded), 0].cpu(),
+					ts = ts,
+					I = alignment[:len(decoded)],
+					channel = channel,
+					speaker = speaker,
+					key = 'ref',
+					speakers = speakers
+				)
 		except:
 			if (not args.oom_crash) and utils.handle_out_of_memory_exception(model.parameters()):
 				print(f'Skipping {i} / {num_examples}')
@@ -1,11 +1,18 @@
 import os
 import math
+import time
+import argparse
 import tempfile
+import itertools
+import fractions
 import random
 import subprocess
 import torch
+import torch.nn.functional as F
 import librosa
 import torchaudio
+import audio
+import shards
 import models
 import numpy as np
 
@@ -18,10 +25,10 @@ class RandomCompose:
 		self.transforms = transforms
 		self.prob = prob
 
-	def __call__(self, *x):
+	def __call__(self, *x, **kwargs):
 		if random.random() < self.prob:
 			transform = random.choice(self.transforms)
-			x = transform(*x)
+			x = transform(*x, **kwargs)
 		return x
 
 	def __str__(self):
@@ -35,9 +42,13 @@ class RandomCompose:
 
 
 class SoxAug(RandomCompose):
-	def __init__(self, transforms, prob, bug = None):
+	def __init__(self, transforms, prob, bug = None, codec_bank = None):
+		# e.g. a codec bank dir passed positionally in place of prob
+		assert isinstance(prob, (int, float)) and not isinstance(prob, bool), f'prob must be a number, got {prob!r}'
 		super().__init__(transforms, prob)
 		self.bug = bug
+		# transcode_* effects are read from the precomputed bank when it has the file, sox is only the fallback
+		self.codec_bank = shards.CodecBank(codec_bank) if isinstance(codec_bank, str) else codec_bank
 
 	def __call__(
 		self,
@@ -54,22 +65,29 @@ class SoxAug(RandomCompose):
 			effect = ([transform[0], fixed_or_choice(transform[1])]
 						if transform[0] in defaults else transform[0]) if isinstance(transform, tuple) else []
 
-		tmp_audio_path = []
+		tmp_audio_path, signal = [], None
 		if effect and isinstance(effect, str) and effect.startswith('transcode'):
 			codec = effect.split('_')[1]
-			tmp_audio_path = [
-				tempfile.mkstemp(suffix = '.' + codec, dir = tmpdir)[1],
-				tempfile.mkstemp(suffix = '.wav', dir = tmpdir)[1]
-			]
-			subprocess.check_call(['sox', '-V0', audio_path, '-t', codec, '-r', str(sample_rate), tmp_audio_path[0]])
-			if self.bug == 'SoxEffectsChain':
-				subprocess.check_call(['sox', '-V0', tmp_audio_path[0], '-t', 'wav', tmp_audio_path[1]])
-				audio_path = tmp_audio_path[1]
+			banked = self.codec_bank.read(codec, audio_path) if self.codec_bank is not None else None
+			if banked is not None:
+				sample_rate_, signal = banked[0], torch.from_numpy(banked[1].astype(np.float32))
 			else:
-				audio_path = tmp_audio_path[0]
+				tmp_audio_path = [
+					tempfile.mkstemp(suffix = '.' + codec, dir = tmpdir)[1],
+					tempfile.mkstemp(suffix = '.wav', dir = tmpdir)[1]
+				]
+				subprocess.check_call(['sox', '-V0', audio_path, '-t', codec, '-r', str(sample_rate), tmp_audio_path[0]])
+				if self.bug == 'SoxEffectsChain':
+					subprocess.check_call(['sox', '-V0', tmp_audio_path[0], '-t', 'wav', tmp_audio_path[1]])
+					audio_path = tmp_audio_path[1]
+				else:
+					audio_path = tmp_audio_path[0]
 			effect = None
 
-		if self.bug == 'SoxEffectsChain':
+		if signal is not None:
+			pass
+
+		elif self.bug == 'SoxEffectsChain':
 			torchaudio.initialize_sox()
 			sox = torchaudio.sox_effects.SoxEffectsChain()
 			if effect:
@@ -91,7 +109,7 @@ class SoxAug(RandomCompose):
 		for audio_path in tmp_audio_path:
 			os.remove(audio_path)
 		if sample_rate is not None and sample_rate_ != sample_rate:
-			signal, sample_rate_ = dataset.resample(signal, sample_rate_, sample_rate)
+			signal, sample_rate_ = audio.resample(signal, sample_rate_, sample_rate)
 		if normalize:
 			signal = models.normalize_signal(signal)
 		if effect == []:
@@ -99,6 +117,72 @@ class SoxAug(RandomCompose):
 		return signal, sample_rate
 
 
+class PitchShift:
+	# in-process replacement of sox pitch: phase vocoder stretch by the pitch ratio, then resampling back to the original length.
+	# Works on [... x T] tensors, a batch shares one randomly chosen shift
+	def __init__(self, n_cents = [-300, 300]):
+		self.n_cents = n_cents
+
+	def __call__(self, signal, sample_rate):
+		rate = 2 ** (fixed_or_choice(self.n_cents) / 1200)
+		return resample_by_rate(time_stretch(signal, 1 / rate), rate), sample_rate
+
+
+class Tempo:
+	# in-process replacement of sox tempo: phase vocoder time stretch keeping pitch, rate > 1 makes the signal shorter
+	def __init__(self, rate = [0.8, 1.2]):
+		self.rate = rate
+
+	def __call__(self, signal, sample_rate):
+		return time_stretch(signal, fixed_or_choice(self.rate)), sample_rate
+
+
+class Speed:
+	# speed perturbation by resampling, changes both tempo and pitch
+	def __init__(self, rate = [0.9, 1.1]):
+		self.rate = rate
+
+	def __call__(self, signal, sample_rate):
+		return resample_by_rate(signal, fixed_or_choice(self.rate)), sample_rate
+
+
+class Gain:
+	# every row of a batch gets its own gain in dB, uniform from the range
+	def __init__(self, gain_db = [-10, 10]):
+		self.gain_db = gain_db
+
+	def __call__(self, signal, sample_rate):
+		gain_db = torch.empty(signal.shape[:-1] + (1, ), device = signal.device).uniform_(*self.gain_db) if isinstance(self.gain_db, list) else torch.tensor(float(self.gain_db))
+		return signal * 10 ** (gain_db / 20), sample_rate
+
+
+def time_stretch(signal, rate, n_fft = 512, hop_length = 128):
+	# phase vocoder over [... x T], the output has round(T / rate) samples
+	shape, num_frames = signal.shape[:-1], signal.shape[-1]
+	if rate == 1 or num_frames == 0:
+		return signal
+	window = torch.hann_window(n_fft, device = signal.device, dtype = signal.dtype)
+	spec = torch.stft(F.pad(signal.reshape(-1, num_frames), (0, max(0, n_fft - num_frames))), n_fft, hop_length, window = window, return_complex = True)
+	time_steps = torch.arange(0, spec.shape[-1], rate, device = signal.device, dtype = signal.dtype)
+	alphas = time_steps % 1.0
+	phase_advance = torch.linspace(0, math.pi * hop_length, spec.shape[-2], device = signal.device, dtype = signal.dtype)[:, None]
+	spec = F.pad(spec, (0, 2))
+	spec0, spec1 = spec[..., time_steps.long()], spec[..., time_steps.long() + 1]
+	angle0, angle1 = spec0.angle(), spec1.angle()
+	phase = angle1 - angle0 - phase_advance
+	phase = phase - 2 * math.pi * torch.round(phase / (2 * math.pi)) + phase_advance
+	phase_acc = torch.cumsum(torch.cat([angle0[..., :1], phase[..., :-1]], dim = -1), dim = -1)
+	magnitude = alphas * spec1.abs() + (1 - alphas) * spec0.abs()
+	stretched = torch.istft(torch.polar(magnitude, phase_acc), n_fft, hop_length, window = window, length = int(round(num_frames / rate)))
+	return stretched.reshape(shape + (-1, ))
+
+
+def resample_by_rate(signal, rate, max_denominator = 64):
+	# the rate is rounded to a fraction with a small denominator, so that the polyphase kernel stays small
+	rate = fractions.Fraction(rate).limit_denominator(max_denominator)
+	return audio.resample(signal, rate.numerator, rate.denominator)[0] if rate != 1 else signal
+
+
 class Quantization:
 	def __init__(self, quantization_channels = 16):
 		self.quantization_channels = quantization_channels
@@ -123,126 +207,298 @@ class AddWhiteNoise:
 
 
 class MixExternalNoise:
-	def __init__(self, noise_level, noise_data_path, cache = False):
-		self.noise_level = noise_level
+	def __init__(self, noise_level, noise_data_path, sample_rate = None, bank_dir = None):
+		self.noise_level = noise_level if isinstance(noise_level, list) else float(noise_level)
 		self.noise_data_path = noise_data_path
 		self.noise_paths = list(map(str.strip, open(noise_data_path))) if noise_data_path is not None else []
-		self.cache = {noise_path: dataset.read_wav(noise_path) for noise_path in self.noise_paths} if cache else {}
+		self.bank_dir = bank_dir
+		# with a known sample rate the bank is built here, i.e. once in the main process before DataLoader workers start
+		self.noise_bank = self.open_bank(int(sample_rate)) if sample_rate is not None else None
+
+	def open_bank(self, sample_rate):
+		return shards.NoiseBank(self.noise_paths, sample_rate, self.bank_dir or f'{self.noise_data_path}.{sample_rate}.noisebank')
 
 	def __call__(self, signal, sample_rate):
-		noise_path = random.choice(self.noise_paths)
-		noise_level = fixed_or_uniform(self.noise_level)
-		noise, sample_rate_ = self.cache.get(noise_path) or dataset.read_wav(noise_path, sample_rate = sample_rate, max_duration = 1.0 + len(signal) / sample_rate)
-		if sample_rate_ != sample_rate:
-			noise, sample_rate_ = dataset.resample(noise, sample_rate_, sample_rate)
-		noise = torch.cat([noise] * (1 + len(signal) // len(noise)))[:len(signal)]
-		return signal + noise * noise_level, sample_rate
+		if self.noise_bank is None or self.noise_bank.sample_rate != sample_rate:
+			self.noise_bank = self.open_bank(sample_rate)
+		num_rows = signal[..., 0].numel()
+		noise = torch.from_numpy(audio.s2f_numpy(np.stack([self.noise_bank.sample(signal.shape[-1]) for i in range(num_rows)]))).view_as(signal)
+		noise_level = torch.tensor([fixed_or_uniform(self.noise_level) for i in range(num_rows)], dtype = signal.dtype).view(*signal.shape[:-1], 1)
+		return signal + noise.to(signal) * noise_level.to(signal.device), sample_rate
+
+
+# spectral transforms take a single (F, T) / (1, F, T) example or a whole collated (B, F, T) batch with xlen (fractions of T as in collate_fn),
+# all masks and noise are drawn as random tensors on the device of the input, so batches can be augmented in collate or on the training device
+
+
+def temporal_lengths(spect, xlen = None):
+	batch = spect.reshape(-1, spect.shape[-2], spect.shape[-1])
+	return batch, (xlen.to(spect.device) * spect.shape[-1]).round().long().view(-1) if xlen is not None else torch.full((len(batch), ), spect.shape[-1], dtype = torch.long, device = spect.device)
+
+
+def random_spans(lengths, num_spans, max_width):
+	# widths uniform in [0, min(max_width, length)], begins uniform in [0, length - width], returns a (B, length.max()) mask of the span union
+	lengths = lengths.unsqueeze(-1)
+	width = (torch.rand(len(lengths), num_spans, device = lengths.device) * (lengths.clamp(max = max_width) + 1)).long()
+	begin = (torch.rand(len(lengths), num_spans, device = lengths.device) * (lengths - width + 1)).long()
+	t = torch.arange(int(lengths.max()) if len(lengths) > 0 else 0, device = lengths.device)
+	return ((t >= begin.unsqueeze(-1)) & (t < (begin + width).unsqueeze(-1))).any(dim = 1)
+
+
+def random_examples(batch, prob):
+	# (B, 1, 1) mask of the examples a transform applies to, drawn per example like RandomCompose does in DataLoader workers
+	return (torch.rand(len(batch), device = batch.device) < prob).view(-1, 1, 1)
 
 
 class SpecLowPass:
-	def __init__(self, freq):
+	def __init__(self, freq, prob = 1.0):
 		self.freq = int(freq)
+		self.prob = float(prob)
 
-	def __call__(self, spect, sample_rate):
+	def __call__(self, spect, sample_rate, xlen = None):
 		mel_cut, mel_max = librosa.hz_to_mel(self.freq), librosa.hz_to_mel(sample_rate / 2)
-		n_freq = int(len(spect) * mel_cut / mel_max)
-		spect[n_freq:] = 0
-		return spect, sample_rate
+		n_freq = int(spect.shape[-2] * mel_cut / mel_max)
+		batch = spect.reshape(-1, spect.shape[-2], spect.shape[-1])
+		batch.masked_fill_(random_examples(batch, self.prob) & (torch.arange(batch.shape[1], device = batch.device) >= n_freq).view(1, -1, 1), 0)
+		return batch.view_as(spect), sample_rate
 
 
 class SpecHighPass:
-	def __init__(self, freq):
+	def __init__(self, freq, prob = 1.0):
 		self.freq = int(freq)
+		self.prob = float(prob)
 
-	def __call__(self, spect, sample_rate):
-		mel_cut, mel_max = librosa.hz_to_mel(self.freq), librosa.hz_to_mel(sample_rate / 2),
-		n_freq = int(len(spect) * mel_cut / mel_max)
-		spect[:n_freq] = 0
-		return spect, sample_rate
+	def __call__(self, spect, sample_rate, xlen = None):
+		mel_cut, mel_max = librosa.hz_to_mel(self.freq), librosa.hz_to_mel(sample_rate / 2)
+		n_freq = int(spect.shape[-2] * mel_cut / mel_max)
+		batch = spect.reshape(-1, spect.shape[-2], spect.shape[-1])
+		batch.masked_fill_(random_examples(batch, self.prob) & (torch.arange(batch.shape[1], device = batch.device) < n_freq).view(1, -1, 1), 0)
+		return batch.view_as(spect), sample_rate
 
 
 class SpecAugment:
-	def __init__(self, n_freq_mask = 2, n_time_mask = 5, width_freq_mask = 6, width_time_mask = 10):
+	def __init__(self, n_freq_mask = 2, n_time_mask = 5, width_freq_mask = 6, width_time_mask = 10, prob = 1.0):
 		# fb code: https://github.com/facebookresearch/wav2letter/commit/04c3d80bf66fe749466cd427afbcc936fbdec5cd
 		# width_freq_mask = 27, width_time_mask = 100, and n_freq_mask/n_time_mask = 2
 		# google code: https://github.com/tensorflow/lingvo/blob/master/lingvo/core/spectrum_augmenter.py#L37-L42
 		# width_freq_mask = 10 and width_time_mask = 50, and n_freq_mask/n_time_mask = 2
 
-		self.n_time_mask = n_time_mask
-		self.n_freq_mask = n_freq_mask
-		self.width_time_mask = width_time_mask
-		self.width_freq_mask = width_freq_mask
+		self.n_time_mask = int(n_time_mask)
+		self.n_freq_mask = int(n_freq_mask)
+		self.width_time_mask = int(width_time_mask)
+		self.width_freq_mask = int(width_freq_mask)
+		# applied to every example with this probability, also within a collated batch
+		self.prob = float(prob)
 
-	def __call__(self, spect, sample_rate, replace_val = 0):
-		for idx in range(self.n_freq_mask):
-			f = random.randint(0, self.width_freq_mask)
-			f0 = random.randint(0, spect.shape[0] - f)
-			spect[f0:f0 + f, :] = replace_val
-
-		for idx in range(self.n_time_mask):
-			t = random.randint(0, min(self.width_time_mask, spect.shape[1]))
-			t0 = random.randint(0, spect.shape[1] - t)
-			spect[:, t0:t0 + t] = replace_val
-
-		return spect, sample_rate
+	def __call__(self, spect, sample_rate, xlen = None, replace_val = 0):
+		# time masks stay within the unpadded length of every example
+		batch, lengths = temporal_lengths(spect, xlen)
+		freq_mask = random_spans(torch.full_like(lengths, batch.shape[1]), self.n_freq_mask, self.width_freq_mask)
+		time_mask = random_spans(lengths, self.n_time_mask, self.width_time_mask)
+		mask = (freq_mask.unsqueeze(-1) | F.pad(time_mask, (0, batch.shape[2] - time_mask.shape[1])).unsqueeze(1)) & random_examples(batch, self.prob)
+		batch.masked_fill_(mask, replace_val)
+		return batch.view_as(spect), sample_rate
 
 
 class SpecPerlinNoise:
-	def __init__(self, noise_level = 0.4):
+	def __init__(self, noise_level = 0.4, prob = 1.0):
 		self.noise_level = float(noise_level)
+		self.prob = float(prob)
 
 	def __call__(
 		self,
 		spect,
 		sample_rate,
+		xlen = None,
 		kernel_size = 8,
 		octaves = 4,
 		persistence = 0.5,
 		fade = lambda t: 6 * t**5 - 15 * t**4 + 10 * t**3
 	):
-		def rand_perlin_2d(spect, kernel_size):
-			shape = [(1 + s // (2 * kernel_size)) * (2 * kernel_size) for s in spect.shape]
+		batch, lengths = temporal_lengths(spect, xlen)
+		F_, T_ = batch.shape[1:]
 
-			delta = (kernel_size / shape[0], kernel_size / shape[1])
+		def rand_perlin_2d(kernel_size):
+			# one gradient lattice per example; within a lattice cell the noise is separable, so everything except the final
+			# interpolation along time is computed at lattice columns and only then expanded to all frames
+			shape = [(1 + s // (2 * kernel_size)) * (2 * kernel_size) for s in (F_, T_)]
 			d = (shape[0] // kernel_size, shape[1] // kernel_size)
-			grid = torch.stack(
-				torch.meshgrid(torch.arange(0, kernel_size, delta[0]), torch.arange(0, kernel_size, delta[1])),
-				dim = -1
-			) % 1
-
-			angles = 2 * math.pi * torch.rand(kernel_size + 1, kernel_size + 1)
-			gradients = torch.stack((torch.cos(angles), torch.sin(angles)), dim = -1)
-			g00 = gradients[0:-1, 0:-1].repeat_interleave(d[0], 0).repeat_interleave(d[1], 1)
-			g10 = gradients[1:, 0:-1].repeat_interleave(d[0], 0).repeat_interleave(d[1], 1)
-			g01 = gradients[0:-1, 1:].repeat_interleave(d[0], 0).repeat_interleave(d[1], 1)
-			g11 = gradients[1:, 1:].repeat_interleave(d[0], 0).repeat_interleave(d[1], 1)
-
-			sum_stack = lambda grid, grad, d0, d1: (torch.stack((grid[:spect.shape[0],:spect.shape[1],0] + d0  , grid[:spect.shape[0],:spect.shape[1],1] + d1  ), dim = -1) * grad[:spect.shape[0], :spect.shape[1]]).sum(dim = -1)
-			n00 = sum_stack(grid, g00, 0, 0)
-			n10 = sum_stack(grid, g10, -1, 0)
-			n01 = sum_stack(grid, g01, 0, -1)
-			n11 = sum_stack(grid, g11, -1, -1)
-			t = fade(grid[:spect.shape[0], :spect.shape[1]])
-			n0 = torch.lerp(n00, n10, t[:, :, 0])
-			n1 = torch.lerp(n01, n11, t[:, :, 0])
-			return math.sqrt(2) * torch.lerp(n0, n1, t[:, :, 1])
-
-		noise = torch.zeros_like(spect)
+			fx = (torch.arange(0, kernel_size, kernel_size / shape[0], device = spect.device)[:F_] % 1).unsqueeze(-1)
+			fy = torch.arange(0, kernel_size, kernel_size / shape[1], device = spect.device)[:T_] % 1
+
+			angles = 2 * math.pi * torch.rand(len(batch), kernel_size + 1, kernel_size + 1, device = spect.device)
+			row = torch.arange(F_, device = spect.device) // d[0]
+			cos, sin = torch.cos(angles), torch.sin(angles)
+			a = torch.lerp(fx * cos[:, row], (fx - 1) * cos[:, row + 1], fade(fx))
+			b = torch.lerp(sin[:, row], sin[:, row + 1], fade(fx))
+			cols = lambda z, j: z[..., j:j + kernel_size].repeat_interleave(d[1], dim = -1)[..., :T_]
+			n0 = cols(a, 0) + fy * cols(b, 0)
+			n1 = cols(a, 1) + (fy - 1) * cols(b, 1)
+			return math.sqrt(2) * torch.lerp(n0, n1, fade(fy))
+
+		noise = torch.zeros_like(batch)
 		frequency = 1
 		amplitude = 1
 		for _ in range(octaves):
-			noise += amplitude * rand_perlin_2d(spect, frequency * kernel_size)
+			noise += amplitude * rand_perlin_2d(frequency * kernel_size)
 			frequency *= 2
 			amplitude *= persistence
-		return spect + self.noise_level * noise, sample_rate
-
-
-AWN = lambda prob = 1.0: SoxAug([AddWhiteNoise()], prob)
-PS = lambda prob = 1.0: SoxAug(['pitch'], prob)
-SP = lambda prob = 1.0: SoxAug(['tempo'], prob)
-AMRNB = lambda prob = 1.0: SoxAug(['transcode_amr-nb'], prob)
-GSM = lambda prob = 1.0: SoxAug(['transcode_gsm'], prob)
-PSSPAMRNB = lambda prob = 1.0: SoxAug(['pitch', 'tempo', 'transcode_amr-nb'], prob)
+		# padding and examples left clean stay zero
+		noise *= (torch.arange(T_, device = spect.device) < lengths.unsqueeze(-1)).unsqueeze(1) & random_examples(batch, self.prob)
+		return spect + self.noise_level * noise.view_as(spect), sample_rate
+
+
+AWN = lambda prob = 1.0: RandomCompose([AddWhiteNoise()], prob)
+PS = lambda prob = 1.0: RandomCompose([PitchShift()], prob)
+SP = lambda prob = 1.0: RandomCompose([Tempo()], prob)
+SPEED = lambda prob = 1.0: RandomCompose([Speed()], prob)
+GAIN = lambda prob = 1.0: RandomCompose([Gain()], prob)
+PS_SOX = lambda prob = 1.0: SoxAug(['pitch'], prob)
+SP_SOX = lambda prob = 1.0: SoxAug(['tempo'], prob)
+AMRNB = lambda prob = 1.0, codec_bank = None: SoxAug(['transcode_amr-nb'], prob, codec_bank = codec_bank)
+GSM = lambda prob = 1.0, codec_bank = None: SoxAug(['transcode_gsm'], prob, codec_bank = codec_bank)
+PSSPAMRNB = lambda prob = 1.0, codec_bank = None: SoxAug(['pitch', 'tempo', 'transcode_amr-nb'], prob, codec_bank = codec_bank)
 
 PS_BUG_SoxEffectsChain = lambda prob = 1.0: SoxAug(['pitch'], prob, bug = 'SoxEffectsChain')
 PS_BUG_as_tensor = lambda prob = 1.0: SoxAug(['pitch'], prob, bug = 'as_tensor')
+
+
+if __name__ == '__main__':
+	import json
+	import utils
+	import datasets
+
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers()
+	cmd = subparsers.add_parser('throughput', help = 'in-process waveform transforms against the sox subprocess path on the same audio')
+	cmd.add_argument('--audio-path', help = 'defaults to a synthetic tone written to a temp wav')
+	cmd.add_argument('--sample-rate', type = int, default = 8_000)
+	cmd.add_argument('--duration', type = float, default = 5.0)
+	cmd.add_argument('--num-examples', type = int, default = 20)
+	cmd.add_argument('--batch-size', type = int, default = 16, help = 'rows of the batched in-process variant')
+	cmd.add_argument('--transforms', nargs = '*', default = ['PS', 'SP', 'SPEED', 'GAIN', 'PS_SOX', 'SP_SOX'])
+	cmd.set_defaults(func = 'throughput')
+
+	cmd = subparsers.add_parser('pipeline', help = 'cost of every augmentation option in AugmentationFrontend over a sample manifest')
+	cmd.add_argument('--data-path', '-i', required = True)
+	cmd.add_argument('--sample-rate', type = int, default = 8_000)
+	cmd.add_argument('--lang', default = 'ru')
+	cmd.add_argument('--frontend', default = 'LogFilterBankFrontend')
+	cmd.add_argument('--num-input-features', type = int, default = 64)
+	cmd.add_argument('--window-size', type = float, default = 0.02)
+	cmd.add_argument('--window-stride', type = float, default = 0.01)
+	cmd.add_argument('--window', default = 'hann_window', choices = ['hann_window', 'hamming_window'])
+	cmd.add_argument('--audio-backend', default = None, choices = [None, 'sox', 'ffmpeg', 'pool', 'mmap', 'soundfile'])
+	cmd.add_argument('--max-duration', type = float, default = 10.0)
+	cmd.add_argument('--waveform-transforms', nargs = '*', default = ['AWN', 'PS', 'SP', 'SPEED', 'GAIN', 'AMRNB', 'GSM'], help = 'name[:arg[:arg...]] as in --train-waveform-transform, e.g. MixExternalNoise:0.3:noise.txt')
+	cmd.add_argument('--feature-transforms', nargs = '*', default = ['SpecAugment', 'SpecPerlinNoise', 'SpecLowPass:1000', 'SpecHighPass:200'])
+	cmd.add_argument('--num-examples', type = int, default = 64, help = 'first examples of the manifest, the same sample is used for the stage timings and the DataLoader runs')
+	cmd.add_argument('--num-workers', type = int, nargs = '+', default = [0, 4])
+	cmd.add_argument('--batch-size', type = int, default = 16)
+	cmd.add_argument('--output-path', '-o', default = 'data/augmentation_benchmark.json')
+	cmd.set_defaults(func = 'pipeline')
+	args = parser.parse_args()
+
+	if args.func == 'throughput':
+		audio_path = args.audio_path
+		if audio_path is None:
+			audio_path = tempfile.mkstemp(suffix = '.wav')[1]
+			t = torch.arange(int(args.duration * args.sample_rate), dtype = torch.float32) / args.sample_rate
+			audio.write_audio(audio_path, 0.5 * torch.sin(2 * math.pi * 440 * t), args.sample_rate)
+		signal, sample_rate = audio.read_audio(audio_path, sample_rate = args.sample_rate, mono = True)
+
+		for name in args.transforms:
+			transform = globals()[name](1.0)
+			sox = isinstance(transform, SoxAug)
+			cases = [('example', signal)] + ([('batch', signal.expand(args.batch_size, -1).contiguous())] if not sox else [])
+			for case, x in cases:
+				try:
+					tic = time.time()
+					for i in range(args.num_examples):
+						transform(audio_path if sox else x, sample_rate)
+					elapsed = time.time() - tic
+					num_examples = args.num_examples * len(x)
+					print(f'{name:>8} {case:>8}: {num_examples / elapsed:8.1f} examples/sec, {num_examples * signal.shape[-1] / sample_rate / elapsed:8.1f} audio sec/sec')
+				except Exception as e:
+					print(f'{name:>8} {case:>8}: failed [{e.__class__.__name__}: {e}]')
+
+		if args.audio_path is None:
+			os.remove(audio_path)
+
+	if args.func == 'pipeline':
+		# every case is one transform on top of the plain frontend; stages are timed in this process with a single cpu thread,
+		# like a DataLoader worker, then the same AugmentationFrontend runs inside AudioTextDataset for every --num-workers
+		utils.reset_cpu_threads(1)
+		make_transform = lambda spec: globals()[spec.split(':')[0]](*spec.split(':')[1:]) if spec else None
+		stages = ['decode', 'waveform', 'frontend', 'feature']
+		frontend = getattr(models, args.frontend)(
+			out_channels = args.num_input_features,
+			sample_rate = args.sample_rate,
+			window_size = args.window_size,
+			window_stride = args.window_stride,
+			window = args.window
+		)
+		labels = datasets.Labels(datasets.Language(args.lang))
+		# only the sample is parsed; it is written to a temporary manifest for the DataLoader runs, so both measure the same examples
+		examples = list(itertools.islice(datasets.iter_manifest(args.data_path), args.num_examples))
+		sample_dir = tempfile.TemporaryDirectory()
+		sample_path = os.path.join(sample_dir.name, 'sample.json')
+		json.dump(examples, open(sample_path, 'w'), ensure_ascii = False)
+		# AudioTextDataset groups utterances by audio_path into one example, which is read once
+		sample = datasets.ManifestIndex.read(sample_path)
+		examples = [sample[i][0] for i in range(len(sample))]
+		read_audio = lambda t: shards.read_audio(t['shard_path'], t['shard_offset'], t['shard_length'], sample_rate = args.sample_rate, duration = args.max_duration) if 'shard_path' in t else \
+			audio.read_audio(t['audio_path'], sample_rate = args.sample_rate, mono = True, backend = args.audio_backend, duration = args.max_duration)
+
+		def run_stages(aug_frontend):
+			cpu_ms, latency_ms = {stage: 0.0 for stage in stages}, []
+			for t in examples:
+				tic, clock = time.perf_counter(), [time.process_time()]
+				signal = read_audio(t)[0] if aug_frontend.read_audio else t['audio_path']
+				clock.append(time.process_time())
+				signal = aug_frontend.waveform_transform(signal, args.sample_rate)[0] if aug_frontend.waveform_transform is not None else signal
+				clock.append(time.process_time())
+				features = aug_frontend.frontend(signal)
+				clock.append(time.process_time())
+				features = aug_frontend.feature_transform(features, args.sample_rate)[0] if aug_frontend.feature_transform is not None else features
+				clock.append(time.process_time())
+				latency_ms.append((time.perf_counter() - tic) * 1000)
+				for stage, begin, end in zip(stages, clock, clock[1:]):
+					cpu_ms[stage] += (end - begin) * 1000 / len(examples)
+			return dict(p50_ms = float(np.percentile(latency_ms, 50)), p95_ms = float(np.percentile(latency_ms, 95)), **{stage + '_cpu_ms': cpu_ms[stage] for stage in stages})
+
+		def run_workers(aug_frontend, num_workers):
+			# max_duration only truncates reads like in run_stages, longer examples are not filtered out
+			dataset = datasets.AudioTextDataset(sample_path, [labels], args.sample_rate, frontend = aug_frontend, max_duration = args.max_duration, duration_filter = False, audio_backend = args.audio_backend)
+			batch_sampler = torch.utils.data.BatchSampler(range(len(dataset)), batch_size = args.batch_size, drop_last = False)
+			data_loader = torch.utils.data.DataLoader(dataset, batch_sampler = batch_sampler, collate_fn = dataset.collate_fn, num_workers = num_workers, worker_init_fn = datasets.worker_init_fn)
+			# worker startup and the first batch are excluded
+			batches = iter(data_loader)
+			next(batches)
+			tic, num_examples = time.perf_counter(), 0
+			for meta, *_ in batches:
+				num_examples += len(meta)
+			return num_examples / (time.perf_counter() - tic) if num_examples > 0 else float('nan')
+
+		cases = [(None, None)] + [(spec, None) for spec in args.waveform_transforms] + [(None, spec) for spec in args.feature_transforms]
+		print('| waveform transform | feature transform | p50 ms | p95 ms | ' + ' | '.join(f'{stage} cpu ms' for stage in stages) + ' | ' + ' | '.join(f'ex/sec @{n}' for n in args.num_workers) + ' |')
+		print('|' + '---:|' * (4 + len(stages) + len(args.num_workers)))
+		results = []
+		for waveform_spec, feature_spec in cases:
+			case = dict(waveform_transform = waveform_spec, feature_transform = feature_spec)
+			results.append(case)
+			try:
+				aug_frontend = models.AugmentationFrontend(frontend, waveform_transform = make_transform(waveform_spec), feature_transform = make_transform(feature_spec))
+				case.update(run_stages(aug_frontend))
+				case.update({f'examples_per_sec_{n}': run_workers(aug_frontend, n) for n in args.num_workers})
+			except Exception as e:
+				# e.g. sox codecs without the sox binary
+				case['error'] = f'{type(e).__name__}: {e}'
+				print(f'|{waveform_spec or "":>20}|{feature_spec or "":>19}| failed [{case["error"]}]')
+				continue
+			print(f'|{waveform_spec or "":>20}|{feature_spec or "":>19}|{case["p50_ms"]:8.2f}|{case["p95_ms"]:8.2f}|' + '|'.join(f'{case[stage + "_cpu_ms"]:{len(stage) + 8}.2f}' for stage in stages) + '|' + '|'.join(f'{case[f"examples_per_sec_{n}"]:{len(str(n)) + 8}.1f}' for n in args.num_workers) + '|')
+
+		if os.path.dirname(args.output_path):
+			os.makedirs(os.path.dirname(args.output_path), exist_ok = True)
+		json.dump(results, open(args.output_path, 'w'), indent = 2)
+		print(args.output_path)